@@ -0,0 +1,239 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import numpy as np
+from catalog import Catalog
+from database import DBCMD, Database, StructContextual, StructDatabase
+from file_io import read_bit_windows, read_bits, read_bytes, write_bit_chunks, write_bits, write_bytes
+from storage import SDB_VERSION
+
+# Benchmarks of the catalog hot paths on deterministic synthetic inputs
+# Results are written as JSON, a run compared against an earlier results file fails when a benchmark got slower than the threshold
+
+# Kinds of synthetic input
+INPUT_KINDS = ('random', 'repetitive', 'text')
+# Default input sizes, in bytes
+INPUT_SIZES = (1 << 10, 1 << 12, 1 << 14)
+# Default number of timed runs of each benchmark, the fastest run is compared
+REPEAT = 3
+# Default fraction a benchmark may be slower than the baseline before the run fails
+THRESHOLD = 0.25
+# Runs faster than this many seconds are not compared, their timings are mostly noise
+MIN_COMPARED_TIME = 1e-3
+# Windows each input is split into by the windowed catalog benchmark
+WINDOW_COUNT = 4
+
+# Words text-like inputs are made of, drawn with Zipf-like frequencies
+TEXT_WORDS = ("the of and to in is that for it as with was on be by at this from or an are not have which "
+              "struct data value database catalog blueprint pointer index segment relation context").split()
+
+# Returns size bytes of synthetic input, the same for every run with the same seed
+def make_input(kind, size, seed=0):
+    rng = np.random.default_rng(seed)
+    if kind == 'random':
+        return rng.integers(0, 256, size, dtype=np.uint8).tobytes()
+    if kind == 'repetitive':
+        pattern = rng.integers(0, 256, 64, dtype=np.uint8).tobytes()
+        return (pattern * (size // len(pattern) + 1))[:size]
+    if kind == 'text':
+        weights = 1 / np.arange(1, len(TEXT_WORDS) + 1)
+        words = rng.choice(TEXT_WORDS, size // 3 + 1, p=weights / weights.sum())
+        return ' '.join(words).encode()[:size]
+    raise ValueError(f"Unknown input kind: {kind}")
+
+# Runs setup and then the timed function repeat times, returns the timing of each run in seconds
+# Setup returns the arguments of the timed function, so state changed by one run does not leak into the next
+def time_runs(function, setup, repeat):
+    timings = []
+    for _ in range(repeat):
+        args = setup()
+        with quiet():
+            start = time.perf_counter()
+            function(*args)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+# Silences the progress prints of the catalog and database
+@contextlib.contextmanager
+def quiet():
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+class Benchmark:
+    def __init__(self, work_dir, repeat=REPEAT):
+        self.work_dir = work_dir
+        self.repeat = repeat
+        self.results = {}
+        self.run_count = 0
+
+    # Returns a new empty directory for a database
+    def new_dir(self):
+        self.run_count += 1
+        path = os.path.join(self.work_dir, f"run{self.run_count}")
+        os.makedirs(path)
+        return path
+
+    # Returns a catalog of a new database with the byte structs initialized, converted segments are not cached
+    def new_catalog(self):
+        with quiet():
+            catalog = Catalog(Database(self.new_dir()), segment_cache_size=0)
+            catalog.ensure_structs()
+        return catalog
+
+    # Returns a catalog and the struct its database holds for the bits, the database is not saved
+    def catalogued(self, bits):
+        catalog = self.new_catalog()
+        with quiet():
+            struct = catalog.catalog_substructs(catalog.convert_to_substructs(bits))
+        return catalog, struct
+
+    def record(self, name, kind, size, timings):
+        self.results[f"{name}/{kind}/{size}"] = {
+            'min': min(timings),
+            'median': statistics.median(timings),
+            'bytes': size,
+            'mb_per_s': size / min(timings) / (1 << 20) if min(timings) > 0 else None,
+        }
+        print(f"{name:<24}{kind:<12}{size:>10} B  {min(timings) * 1000:10.3f} ms")
+
+    # Runs every benchmark on one input
+    def run(self, kind, size):
+        data = make_input(kind, size)
+        path = os.path.join(self.work_dir, f"{kind}-{size}.bin")
+        write_bytes(path, data)
+        bits = read_bits(path)
+        out_path = path + ".out"
+
+        self.record('read_bits', kind, size, time_runs(read_bits, lambda: (path,), self.repeat))
+        self.record('write_bits', kind, size, time_runs(write_bits, lambda: (out_path, bits), self.repeat))
+
+        self.record('convert_to_substructs', kind, size, time_runs(
+            lambda catalog: catalog.convert_to_substructs(bits),
+            lambda: (self.new_catalog(),),
+            self.repeat))
+
+        def struct_setup():
+            catalog = self.new_catalog()
+            return catalog, catalog.convert_to_substructs(bits)
+        self.record('struct_from_substructs', kind, size, time_runs(
+            lambda catalog, substructs: catalog.struct_from_substructs(substructs),
+            struct_setup,
+            self.repeat))
+
+        # The array path every catalog run takes, the same tree as struct_from_substructs added in pairs per level
+        def ids_setup():
+            catalog = self.new_catalog()
+            return catalog, catalog.convert_to_ids(bits)
+        self.record('struct_from_ids', kind, size, time_runs(
+            lambda catalog, substruct_ids: catalog.struct_from_ids(substruct_ids),
+            ids_setup,
+            self.repeat))
+
+        # Large files are read, converted and reduced one window at a time, including the save of the database
+        window_size = max(1, size // WINDOW_COUNT)
+        self.record('try_catalog_windows', kind, size, time_runs(
+            lambda catalog: catalog.try_catalog_windows(read_bit_windows(path, window_size)),
+            lambda: (self.new_catalog(),),
+            self.repeat))
+
+        # Adding every struct with substructs again only finds the existing structs
+        def dedup_setup():
+            catalog, _ = self.catalogued(bits)
+            structs = catalog.database.query(DBCMD.GET_STRUCTS)
+            return catalog.database, [StructContextual(substructs=list(struct.substructs))
+                                      for struct in structs if struct and struct.substructs]
+        def add_again(database, structs):
+            for struct in structs:
+                database.query(DBCMD.ADD_STRUCT, struct)
+        self.record('add_struct_dedup', kind, size, time_runs(add_again, dedup_setup, self.repeat))
+
+        def sdb_setup():
+            catalog, _ = self.catalogued(bits)
+            return catalog.database.struct_db,
+        self.record('to_sdb', kind, size, time_runs(lambda struct_db: struct_db.to_sdb(SDB_VERSION), sdb_setup, self.repeat))
+
+        def bytes_setup():
+            struct_db, = sdb_setup()
+            return struct_db.to_sdb(SDB_VERSION)
+        self.record('from_bytes', kind, size, time_runs(
+            lambda db_bytes, ptrs_bytes: StructDatabase.from_bytes(db_bytes, ptrs_bytes).load_all(),
+            bytes_setup,
+            self.repeat))
+
+        # Restores from a database loaded from its files, as when restoring a blueprint from the command line
+        def restore_setup():
+            catalog = self.new_catalog()
+            with quiet():
+                blueprint = catalog.try_catalog(bits)
+            return catalog.database.working_dir, blueprint
+        def restore(db_dir, blueprint):
+            struct = Database(db_dir).query(DBCMD.GET_BLUEPRINT_STRUCT, blueprint)
+            write_bit_chunks(out_path, struct.iter_value_chunks())
+        self.record('blueprint_restore', kind, size, time_runs(restore, restore_setup, self.repeat))
+
+# Returns the benchmarks which got slower than the baseline by more than the threshold, as (name, baseline, time)
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or max(result['min'], base['min']) < MIN_COMPARED_TIME:
+            continue
+        if result['min'] > base['min'] * (1 + threshold):
+            regressions.append((name, base['min'], result['min']))
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the N-STRUCT catalog hot paths on synthetic inputs.")
+    parser.add_argument("--sizes", type=lambda text: [int(size) for size in text.split(',')], default=list(INPUT_SIZES),
+                        help="Comma separated input sizes in bytes")
+    parser.add_argument("--kinds", type=lambda text: text.split(','), default=list(INPUT_KINDS),
+                        help=f"Comma separated input kinds out of {', '.join(INPUT_KINDS)}")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="Timed runs of each benchmark")
+    parser.add_argument("--output", default="benchmark.json", help="File the JSON results are written to")
+    parser.add_argument("--compare", metavar="BASELINE", help="Results file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="Fraction a benchmark may be slower than the baseline before the run fails")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    work_dir = tempfile.mkdtemp(prefix="nstruct-bench-")
+    try:
+        benchmark = Benchmark(work_dir, args.repeat)
+        for size in args.sizes:
+            for kind in args.kinds:
+                benchmark.run(kind, size)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+        },
+        'results': benchmark.results,
+    }
+    write_bytes(os.path.abspath(args.output), json.dumps(report, indent=2).encode())
+    print("Saved benchmark results to:", args.output)
+
+    if args.compare:
+        baseline = json.loads(read_bytes(args.compare))['results']
+        regressions = find_regressions(benchmark.results, baseline, args.threshold)
+        for name, base_time, new_time in regressions:
+            print(f"Regression: {name} {base_time * 1000:.3f} ms -> {new_time * 1000:.3f} ms")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions over {args.threshold:.0%} against:", args.compare)
+
+if __name__ == "__main__":
+    main()
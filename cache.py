@@ -0,0 +1,211 @@
+from collections import OrderedDict
+import sys
+from metrics import metrics
+
+# Returned by Cache.get for keys which are not cached, so a cached None (negative entry) can be told apart from a miss
+MISSING = object()
+# Share of the byte budget of an admission cache kept for the window of new entries
+WINDOW_SHARE = 0.01
+# Share of the main space kept for entries hit again after they were admitted
+PROTECTED_SHARE = 0.8
+# Counters of the frequency sketch per byte of cache budget, rounded up to a power of 2
+SKETCH_COUNTERS_PER_BYTE = 1 / 64
+# Most counters of the frequency sketch
+SKETCH_MAX_COUNTERS = 1 << 20
+# Largest count of a frequency counter, counts are halved once the sketch has seen 10 times as many keys as it has counters
+SKETCH_MAX_COUNT = 15
+
+# Approximate access frequency of keys, a count-min sketch with 4 hashed counters per key which ages over time
+class FrequencySketch:
+    def __init__(self, counters):
+        size = 1 << max(4, (counters - 1).bit_length())
+        self.mask = size - 1
+        self.rows = [bytearray(size) for _ in range(4)]
+        self.seeds = (0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f, 0x165667b19e3779f9, 0x27d4eb2f165667c5)
+        self.additions = 0
+        self.sample_size = 10 * size
+
+    def _indexes(self, key):
+        key_hash = hash(key)
+        return [((key_hash * seed) >> 17) & self.mask for seed in self.seeds]
+
+    def increment(self, key):
+        for row, index in zip(self.rows, self._indexes(key)):
+            if row[index] < SKETCH_MAX_COUNT:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self._age()
+
+    def frequency(self, key):
+        return min(row[index] for row, index in zip(self.rows, self._indexes(key)))
+
+    # Halves every counter, so keys which are no longer accessed lose their frequency
+    def _age(self):
+        halve = bytes(count >> 1 for count in range(256))
+        self.rows = [bytearray(row.translate(halve)) for row in self.rows]
+        self.additions //= 2
+
+# Estimated bytes of the bookkeeping of each cache entry, on top of its key and value
+ENTRY_BYTES = 100
+# Estimated bytes of each int in a cached tuple or list
+INT_BYTES = 28
+
+# Estimates the size of a cache entry in bytes, tuples and lists are taken to hold small ints
+def estimate_size(key, value):
+    size = ENTRY_BYTES
+    for item in (key, value):
+        size += sys.getsizeof(item)
+        if isinstance(item, (list, tuple)):
+            size += INT_BYTES * len(item)
+    return size
+
+# Size-aware cache with a byte budget
+# Without admission it evicts the least recently used entries once the entries are over the budget
+# With admission (W-TinyLFU) new entries go to a small window, an entry leaving the window only replaces
+# an entry of the main space if its key is accessed more often, so one pass over new keys (a large file) does not
+# flush the entries in use. The main space is split into probation and protected entries, entries hit while in
+# probation are protected
+# None values are cached like any other value, get with default MISSING tells them apart from a miss
+# Hits and misses are also counted in the metrics under the name of the cache
+class Cache:
+    def __init__(self, max_bytes, name="cache", admission=False, sizeof=estimate_size, on_evict=None):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.sizeof = sizeof # Returns the estimated bytes of an entry from its key and value
+        self.on_evict = on_evict # Called with the key and value of each entry evicted or not admitted
+        self.window = OrderedDict() # Every entry without admission, new entries with admission, (value, size) by key
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.window_bytes = 0
+        self.probation_bytes = 0
+        self.protected_bytes = 0
+        self.sketch = None
+        self.window_max = max_bytes
+        if admission and max_bytes > 0:
+            self.sketch = FrequencySketch(min(SKETCH_MAX_COUNTERS, int(max_bytes * SKETCH_COUNTERS_PER_BYTE) + 1))
+            self.window_max = max(1, int(max_bytes * WINDOW_SHARE))
+        self.main_max = max_bytes - self.window_max
+        self.protected_max = int(self.main_max * PROTECTED_SHARE)
+
+        # Counted on every lookup, so they are plain counters the metrics read rather than metrics.count calls
+        self.hit_counter = metrics.counter(f'{name}_cache_hits')
+        self.miss_counter = metrics.counter(f'{name}_cache_misses')
+        self.evictions = 0
+        self.rejections = 0 # Entries leaving the window which were not admitted to the main space
+
+    @property
+    def hits(self):
+        return self.hit_counter.value
+
+    @property
+    def misses(self):
+        return self.miss_counter.value
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+    def __contains__(self, key):
+        return key in self.window or key in self.probation or key in self.protected
+
+    def get(self, key, default=None):
+        entry = self.touch(key)
+        if entry is None:
+            self.miss_counter.value += 1
+            return default
+        self.hit_counter.value += 1
+        return entry[0]
+
+    # Records an access to a key without counting a hit or miss, returns its (value, size) entry or None if it is not cached
+    # Used by callers which hold the value already, so recency and frequency still follow their accesses
+    def touch(self, key):
+        if self.sketch:
+            self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+            return self.window[key]
+        if key in self.protected:
+            self.protected.move_to_end(key)
+            return self.protected[key]
+        if key in self.probation:
+            entry = self.probation.pop(key)
+            self.probation_bytes -= entry[1]
+            self._protect(key, entry)
+            return entry
+        return None
+
+    def put(self, key, value):
+        size = self.sizeof(key, value)
+        if size > self.max_bytes or size > self.window_max and not self.sketch:
+            return
+        self.discard(key)
+        self.window[key] = (value, size)
+        self.window_bytes += size
+        while self.window_bytes > self.window_max:
+            candidate_key, candidate = self.window.popitem(last=False)
+            self.window_bytes -= candidate[1]
+            if self.sketch:
+                self._admit(candidate_key, candidate)
+            else:
+                self._evicted(candidate_key, candidate)
+
+    # Removes a key, used when a cached value becomes stale
+    def discard(self, key):
+        for entries, size_name in ((self.window, 'window_bytes'), (self.probation, 'probation_bytes'), (self.protected, 'protected_bytes')):
+            entry = entries.pop(key, None)
+            if entry is not None:
+                setattr(self, size_name, getattr(self, size_name) - entry[1])
+                return
+
+    def clear(self):
+        self.window = OrderedDict()
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.window_bytes = self.probation_bytes = self.protected_bytes = 0
+
+    # Moves an entry leaving the window to probation, if it is accessed more often than the entries it would evict
+    def _admit(self, key, entry):
+        victims = []
+        free = self.main_max - self.probation_bytes - self.protected_bytes
+        victim_keys = iter(list(self.probation) + list(self.protected))
+        frequency = self.sketch.frequency(key)
+        while free < entry[1]:
+            victim_key = next(victim_keys, None)
+            if victim_key is None or self.sketch.frequency(victim_key) >= frequency:
+                self.rejections += 1
+                if self.on_evict:
+                    self.on_evict(key, entry[0])
+                return
+            victims.append(victim_key)
+            free += (self.probation.get(victim_key) or self.protected[victim_key])[1]
+        for victim_key in victims:
+            victim = self.probation.get(victim_key) or self.protected[victim_key]
+            self.discard(victim_key)
+            self._evicted(victim_key, victim)
+        self.probation[key] = entry
+        self.probation_bytes += entry[1]
+
+    def _evicted(self, key, entry):
+        self.evictions += 1
+        if self.on_evict:
+            self.on_evict(key, entry[0])
+
+    # Moves an entry hit in probation to the protected entries, the least recently used protected entries go back to probation
+    def _protect(self, key, entry):
+        self.protected[key] = entry
+        self.protected_bytes += entry[1]
+        while self.protected_bytes > self.protected_max and len(self.protected) > 1:
+            demoted_key, demoted = self.protected.popitem(last=False)
+            self.protected_bytes -= demoted[1]
+            self.probation[demoted_key] = demoted
+            self.probation_bytes += demoted[1]
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "rejections": self.rejections,
+            "entries": len(self),
+            "bytes": self.window_bytes + self.probation_bytes + self.protected_bytes,
+        }
@@ -1,23 +1,191 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 from itertools import islice
-import threading
+import os
 import time
+import numpy as np
+from cache import Cache
 from database import DBCMD, StructContextual
+from file_io import SYMBOL_WIDTHS, BitArray, read_bit_windows, read_bits
+from metrics import metrics
+from relations import NEAREST_BLOCK_SIZE, NEAREST_COUNT, ContextRelations, RelationIndex, relation_features
+
+# Number of structs (lowest IDs first) which data is matched against when converting it to substructs
+MATCH_STRUCT_COUNT = 256
+# Default number of bits converted to substructs at a time
+SEGMENT_SIZE = 1024
+# Default memory budget of the segment cache, in bytes
+SEGMENT_CACHE_SIZE = 64 << 20
+# Default number of contextual matches returned for each substruct
+RELATION_MATCH_COUNT = 4
+
+# Matcher, chunk size, symbol table and window size of a worker process converting files, see convert_file
+worker_matcher = None
+worker_chunk_size = SEGMENT_SIZE
+worker_symbols = None
+worker_window_size = 0
+
+# Sets the matcher used by convert_file in this process, or the symbol table when data is catalogued in symbols wider than a bit
+# Files larger than the window size (in bytes) are converted one window at a time, 0 converts every file whole
+def init_convert_worker(matcher, chunk_size=SEGMENT_SIZE, symbols=None, window_size=0):
+    global worker_matcher, worker_chunk_size, worker_symbols, worker_window_size
+    worker_matcher = matcher
+    worker_chunk_size = chunk_size
+    worker_symbols = symbols
+    worker_window_size = window_size
+
+# Reads a file and converts its bits to substruct IDs, converting in chunks the same way as Catalog.convert_to_substructs
+# Files larger than the window size give a list with the IDs of each window, to be catalogued with Catalog.catalog_id_windows
+# Runs in worker processes, so only IDs are returned and the database is left to the caller
+def convert_file(file_path):
+    if worker_window_size and os.path.getsize(file_path) > worker_window_size:
+        return [convert_data(window) for window in read_bit_windows(file_path, worker_window_size)]
+    data = read_bits(file_path, packed=True)
+    if data is None:
+        return None
+    return convert_data(data)
+
+# Converts packed bits to substruct IDs with the worker matcher
+# With a symbol table, converts the bits to symbol codes instead
+def convert_data(data):
+    if worker_symbols:
+        # Symbol codes, the caller looks up their struct IDs with Catalog.symbol_ids
+        return worker_symbols.to_codes(data).astype(np.uint32)
+    data = data.tolist()
+    substruct_ids = []
+    for i in range(0, len(data), worker_chunk_size):
+        substruct_ids.extend(worker_matcher.match(data[i:i+worker_chunk_size]))
+    return np.array(substruct_ids, dtype=np.uint32)
+
+# Converted segments of data keyed by a fixed-size digest of the segment
+# Evicts least recently used segments once the estimated size of all entries is over max_bytes,
+# with admission a segment seen once does not evict segments seen more often
+class SegmentCache(Cache):
+    # Estimated bytes per cached entry and per struct ID in an entry
+    ENTRY_BYTES = 120
+    ID_BYTES = 8
+    
+    def __init__(self, max_bytes, admission=False):
+        super().__init__(max_bytes, 'segment', admission, lambda key, ids: self.ENTRY_BYTES + len(ids) * self.ID_BYTES)
+    
+    # Returns the cache key of a segment converted by a matcher
+    def key(self, fingerprint, segment):
+        digest = hashlib.blake2b(fingerprint, digest_size=16)
+        digest.update(bytes(segment))
+        return digest.digest()
+
+# Number of 16-bit symbols
+WORD_SYMBOLS = 1 << 16
+
+# Struct IDs of the symbols of a width, data maps to the IDs of its symbols with one lookup instead of matching
+# Symbols are the bits of each byte (width 8) or each pair of bytes (width 16) in order, so restoring the data is exact
+# Bits left over at the end of data, under a symbol, are 8-bit and 1-bit symbols
+# Each symbol has a code indexing the IDs: 16-bit symbols first (width 16), then the bytes, then bits 0 and 1
+class SymbolTable:
+    def __init__(self, width, bit_ids, byte_ids):
+        self.width = width
+        self.byte_offset = WORD_SYMBOLS if width == 16 else 0
+        self.bit_offset = self.byte_offset + 256
+        # The struct of a 16-bit symbol is the pair of the structs of its bytes, only made once the symbol appears (-1 until then)
+        word_ids = np.full(self.byte_offset, -1, dtype=np.int64)
+        self.ids = np.concatenate((word_ids, byte_ids, bit_ids)).astype(np.int64)
+    
+    # Returns the symbol codes of bit data, a list of bits or a packed BitArray
+    # Needs no database, so files can be converted in worker processes
+    def to_codes(self, data):
+        if isinstance(data, BitArray):
+            packed, length = data.packed, len(data)
+        else:
+            bits = np.asarray(data, dtype=np.uint8)
+            packed, length = np.packbits(bits), len(bits)
+        byte_count = length // 8
+        data_bytes = np.asarray(packed[:byte_count], dtype=np.int64)
+        
+        codes = []
+        if self.width == 16:
+            word_count = byte_count // 2
+            codes.append((data_bytes[0:word_count * 2:2] << 8) | data_bytes[1:word_count * 2:2])
+            data_bytes = data_bytes[word_count * 2:]
+        codes.append(data_bytes + self.byte_offset)
+        if length % 8:
+            tail_bits = np.unpackbits(np.asarray(packed[byte_count:byte_count + 1], dtype=np.uint8))[:length % 8]
+            codes.append(tail_bits.astype(np.int64) + self.bit_offset)
+        return np.concatenate(codes)
+    
+    # Returns the 16-bit symbols among the codes which have no struct yet, each once
+    def missing_words(self, codes):
+        words = np.unique(codes[codes < self.byte_offset])
+        return words[self.ids[words] < 0]
+
+# Trie over the values of a set of structs, replaces struct values in data with struct IDs in one pass
+# Matching rule: scanning left to right, the longest struct values starting at the current position are replaced
+# When several structs have the same values the highest ID wins
+# Built from (struct ID, values) pairs
+class SubstructMatcher:
+    def __init__(self, struct_values):
+        # Each node maps a value to the next node, a node's struct ID is kept under the None key
+        self.root = {}
+        # Digest of the matched structs, matches are only reusable by a matcher with the same fingerprint
+        fingerprint = hashlib.blake2b(digest_size=16)
+        for id, values in sorted(struct_values, key=lambda item: item[0]):
+            if not values:
+                continue
+            node = self.root
+            for value in values:
+                node = node.setdefault(value, {})
+            node[None] = id
+            fingerprint.update(repr((id, values)).encode())
+        self.fingerprint = fingerprint.digest()
+    
+    # Returns the data with all matches replaced by struct IDs
+    def match(self, data):
+        root = self.root
+        result = []
+        length = len(data)
+        i = 0
+        while i < length:
+            node = root
+            match_id = None
+            match_end = i + 1
+            j = i
+            # Walk the trie as far as the data allows, remembering the longest match
+            while j < length:
+                node = node.get(data[j])
+                if node is None:
+                    break
+                j += 1
+                if None in node:
+                    match_id = node[None]
+                    match_end = j
+            
+            result.append(data[i] if match_id is None else match_id)
+            i = match_end
+        return result
 
 class Catalog:
-    def __init__(self, database, auto=False):
+    def __init__(self, database, auto=False, segment_cache_size=SEGMENT_CACHE_SIZE, cache_admission=False, symbol_width=1):
+        if symbol_width not in SYMBOL_WIDTHS:
+            raise ValueError(f"Unsupported symbol width: {symbol_width}")
         self.database = database
-        # TODO: Implement by checking file system for new files in data directory
+        # Set when the data directory is watched for new files, see Manager.watch
         self.auto = auto
-        self.struct_cache = {}
+        # Converted segments of data, kept across files
+        self.segment_cache = SegmentCache(segment_cache_size, cache_admission)
+        self.matcher = None
+        self.matcher_revision = None
+        # Width of the symbols data is converted to, wider symbols are looked up in the symbol table instead of matched
+        self.symbol_width = symbol_width
+        self.symbol_table = None
+        self.symbol_epoch = None
+        # Relation features of the substructs of indexed data, to find contextually equivalent structs
+        self.relation_index = RelationIndex()
 
     def try_catalog(self, data, chunk_size=1024):
         """
         Interprets bit data, saves important features to the database, and returns the bits for a blueprint of the data.
 
         Args:
-            data (bits): The bit data to be interpreted.
-            chunk_size (int, optional): The size of the chunks to be processed. Defaults to 1024.
+            data (bits): The bit data to be interpreted, a list of bits or a packed BitArray.
+            chunk_size (int, optional): The size of the chunks (in bits) the data is converted in. Defaults to 1024.
 
         Returns:
             bits: An array of bits representing a blueprint of the data.
@@ -34,24 +202,66 @@ class Catalog:
                 - The function analyzes the structs and returns the final struct.
             - The function saves the database and returns the bits of the final struct which will be the blueprint of the data.
         """
-        if len(self.database.query(DBCMD.GET_STRUCTS)) == 0:
-            structs = self.init_structs(data)
+        self.ensure_structs()
         
         # convert data to known substructs
-        start_time = time.time()
-        substructs = self.convert_to_substructs(data)
-        print("Conversion time:", time.time() - start_time)
-        # compress all substructs into one struct
-        start_time = time.time()
-        self.struct_cache = {}
-        struct = self.struct_from_substructs(substructs)
-        print("Reconstruction time: ", time.time() - start_time)
-        # add & save to database
-        struct = self.database.query(DBCMD.ADD_STRUCT, struct)
+        metrics.count('bytes_in', (len(data) + 7) // 8)
+        substruct_ids = self.convert_to_ids(data, chunk_size)
+        # compress all substructs into one struct and add it to the database
+        struct = self.catalog_ids(substruct_ids)
+        # The blueprint records the epoch, so its ID still resolves after later compactions
+        epoch = self.database.query(DBCMD.GET_EPOCH)
+        # save database
         self.database.query(DBCMD.SAVE_DB)
         
         # Return array of bytes representing a blueprint of the data
-        return struct.to_blueprint()
+        blueprint = struct.to_blueprint(epoch=epoch)
+        metrics.count('blueprint_bytes_out', len(blueprint))
+        return blueprint
+    
+    def try_catalog_windows(self, windows, chunk_size=SEGMENT_SIZE):
+        """
+        Catalogs data given as a sequence of windows, like try_catalog, holding one window in memory at a time.
+        
+        Args:
+            windows (iterable): The bit data split into windows, each a list of bits or a packed BitArray.
+            chunk_size (int, optional): The size of the chunks (in bits) each window is converted in. Defaults to SEGMENT_SIZE.
+        
+        Returns:
+            bits: An array of bits representing a blueprint of the data, or None if there is no data.
+        
+        Notes:
+            - Memory is bounded by the window size and the height of the tree.
+            - The tree differs from the one try_catalog builds for the same data, the data restored from both is the same.
+        """
+        self.ensure_structs()
+        
+        struct = self.catalog_windows(windows, chunk_size)
+        if struct is None:
+            return None
+        
+        epoch = self.database.query(DBCMD.GET_EPOCH)
+        self.database.query(DBCMD.SAVE_DB)
+        blueprint = struct.to_blueprint(epoch=epoch)
+        metrics.count('blueprint_bytes_out', len(blueprint))
+        return blueprint
+    
+    # Initializes the byte structs if the database is empty
+    def ensure_structs(self):
+        if len(self.database.query(DBCMD.GET_STRUCTS)) == 0:
+            self.init_structs(None)
+    
+    # Compresses substructs into one struct and adds it to the database, without saving the database
+    def catalog_substructs(self, substructs):
+        with metrics.timer('reduce'):
+            struct = self.struct_from_substructs(substructs)
+            return self.database.query(DBCMD.ADD_STRUCT, struct)
+    
+    # Compresses substruct IDs into one struct in the database, without saving the database
+    def catalog_ids(self, substruct_ids):
+        with metrics.timer('reduce'):
+            struct_id = self.struct_from_ids(substruct_ids)
+        return self.database.query(DBCMD.GET_STRUCT_BY_ID, struct_id)
     
     # Creates structs from groups of substructs of specified size
     def group_substructs(self, substructs, group_size):
@@ -79,8 +289,6 @@ class Catalog:
             return substructs[0]
         
         while len(substructs) > 1:
-            print("substructs len:", len(substructs))
-            
             last_substruct = None
             if len(substructs) % 2 != 0:
                 last_substruct = substructs.pop()
@@ -92,6 +300,66 @@ class Catalog:
                 
         return substructs[0]
     
+    # Compresses windows of data into one struct in the database, without saving the database
+    # Each window is converted and reduced to a subtree as it arrives, then its root is combined with the roots so far
+    # Roots are combined like a binary counter, two subtrees of the same height are paired as soon as both exist,
+    # so at most one root per height is pending
+    def catalog_windows(self, windows, chunk_size=SEGMENT_SIZE):
+        def convert(window):
+            metrics.count('bytes_in', (len(window) + 7) // 8)
+            return self.convert_to_ids(window, chunk_size)
+        # Each window is converted once the windows before it are catalogued
+        return self.catalog_id_windows(map(convert, windows))
+    
+    # Compresses the substruct IDs of consecutive windows into one struct, see catalog_windows
+    def catalog_id_windows(self, id_windows):
+        pending = [] # (root ID, height), heights decrease from the left
+        for ids in id_windows:
+            if len(ids) == 0:
+                continue
+            with metrics.timer('reduce'):
+                root = self.struct_from_ids(ids)
+                height = 0
+                while pending and pending[-1][1] == height:
+                    left, _ = pending.pop()
+                    root = self.pair_ids(left, root)
+                    height += 1
+                pending.append((root, height))
+        
+        if not pending:
+            return None
+        # Combine the remaining roots from the right
+        with metrics.timer('reduce'):
+            root, _ = pending.pop()
+            while pending:
+                left, _ = pending.pop()
+                root = self.pair_ids(left, root)
+        return self.database.query(DBCMD.GET_STRUCT_BY_ID, root)
+    
+    # Returns the ID of the struct made of two substruct IDs
+    def pair_ids(self, left, right):
+        return int(self.database.query(DBCMD.ADD_STRUCT_PAIRS, np.array([left]), np.array([right]))[0])
+    
+    # Builds the same tree as struct_from_substructs, one level at a time from arrays of struct IDs
+    # Each level is split into (left, right) pairs which are added to the database in one query
+    # An odd struct at the end of a level is carried over to the end of the next level
+    # Returns the ID of the struct at the root of the tree
+    def struct_from_ids(self, substruct_ids):
+        level = np.asarray(substruct_ids, dtype=np.int64)
+        if len(level) == 0:
+            return None
+        
+        while len(level) > 1:
+            pair_count = len(level) // 2
+            left = level[0:pair_count * 2:2]
+            right = level[1:pair_count * 2:2]
+            next_level = self.database.query(DBCMD.ADD_STRUCT_PAIRS, left, right)
+            if len(level) % 2 != 0:
+                next_level = np.append(next_level, level[-1])
+            level = next_level
+        
+        return int(level[0])
+    
     # Makes a struct from parameters and adds it to the database
     def create_struct(self, substructs):
         struct = StructContextual(substructs=substructs)
@@ -116,47 +384,120 @@ class Catalog:
             
             # Convert i to an array of bits
             bits = [int(x) for x in bin(i)[2:]]
-            print("init struct bits: ", bits)
             
-            # Add struct
-            substructs = self.convert_to_substructs(bits)
+            # Add struct, byte structs are matched from bits whatever the symbol width
+            substructs = self.structs_by_ids(self.match_ids(bits))
             struct = StructContextual(substructs=substructs)
             struct = self.database.query(DBCMD.ADD_STRUCT, struct)
             struct_contextuals.append(struct)
         
         return struct_contextuals
     
-    # Converts raw bit data into substructs using a binary search
-    def convert_to_substructs(self, data):
-        substruct_ids = data.copy()
-        check_structs = self.database.query(DBCMD.GET_STRUCTS)[255::-1]
-
-        # Sort the structs based on their values
-        #check_structs.sort(key=lambda x: x.get_values())
-
-        for struct in check_structs:
-            # Skip structs larger than the input data
-            if len(struct.get_values()) > len(data):
-                continue
-            else:
-                substruct_ids = self.struct_overlap(struct, substruct_ids)
-            
-            if len(substruct_ids) <= 2:
-                break
-
+    # Converts raw bit data into substructs in a single pass over the data
+    # Values which no struct matches are kept as they are (bits 0 and 1 are also the IDs of the bit structs)
+    # Data is converted in chunks, chunks which were already converted with the same structs are taken from the segment cache
+    def convert_to_substructs(self, data, chunk_size=SEGMENT_SIZE):
+        ids = self.convert_to_ids(data, chunk_size)
         # Get structs from ids
-        return self.structs_by_ids(substruct_ids)
+        return self.structs_by_ids(ids.tolist() if isinstance(ids, np.ndarray) else ids)
+    
+    # Converts raw bit data into the IDs of substructs, see convert_to_substructs
+    # With a symbol width over 1 bit, the data is converted to an array of the IDs of its symbols instead
+    def convert_to_ids(self, data, chunk_size=SEGMENT_SIZE):
+        if self.symbol_width > 1:
+            with metrics.timer('convert'):
+                return self.symbol_ids(self.get_symbol_table().to_codes(data))
+        return self.match_ids(data, chunk_size)
+    
+    # Converts raw bit data into the IDs of substructs by matching the bits against the lowest structs
+    def match_ids(self, data, chunk_size=SEGMENT_SIZE):
+        matcher = self.get_matcher()
+        
+        # Slicing works for both lists and packed BitArrays, a BitArray is only unpacked one chunk at a time
+        start_time = time.perf_counter()
+        unpack_time = 0.0
+        substruct_ids = []
+        for i in range(0, len(data), chunk_size):
+            unpack_start = time.perf_counter()
+            chunk = data[i:i+chunk_size]
+            unpack_time += time.perf_counter() - unpack_start
+            key = self.segment_cache.key(matcher.fingerprint, chunk)
+            chunk_ids = self.segment_cache.get(key)
+            if chunk_ids is None:
+                chunk_ids = matcher.match(chunk)
+                self.segment_cache.put(key, chunk_ids)
+            substruct_ids.extend(chunk_ids)
+        metrics.add_time('unpack', unpack_time)
+        metrics.add_time('convert', time.perf_counter() - start_time - unpack_time)
+        return substruct_ids
+    
+    # Returns the relations of the substructs of some data to each other, to abstract the data left over after Judging
+    def get_relations(self, data, k=NEAREST_COUNT, chunk_size=SEGMENT_SIZE):
+        self.ensure_structs()
+        return ContextRelations(self.convert_to_ids(data, chunk_size), k)
+    
+    # Adds the relations of the substructs of some data to the relation index
+    def index_relations(self, data, chunk_size=SEGMENT_SIZE):
+        self.ensure_structs()
+        ids = np.asarray(self.convert_to_ids(data, chunk_size), dtype=np.int64)
+        relations = ContextRelations(ids)
+        for start in range(0, len(ids), NEAREST_BLOCK_SIZE):
+            end = min(start + NEAREST_BLOCK_SIZE, len(ids))
+            self.relation_index.add(ids[start:end], relation_features(relations, start, end))
+    
+    # Returns, for each substruct of some data, the IDs of the indexed structs with the nearest relations
+    def find_contextual_matches(self, data, limit=RELATION_MATCH_COUNT, chunk_size=SEGMENT_SIZE):
+        relations = self.get_relations(data, chunk_size=chunk_size)
+        matches = []
+        for start in range(0, len(relations), NEAREST_BLOCK_SIZE):
+            end = min(start + NEAREST_BLOCK_SIZE, len(relations))
+            matches.extend(self.relation_index.query(relation_features(relations, start, end), limit))
+        return matches
+    
+    # Returns the matcher for the current database, rebuilt only when the database has changed
+    def get_matcher(self):
+        revision = self.database.query(DBCMD.GET_REVISION)
+        if self.matcher is None or self.matcher_revision != revision:
+            check_ids = [struct.id for struct in self.database.query(DBCMD.GET_STRUCTS)[:MATCH_STRUCT_COUNT] if struct]
+            # Values of all matched structs are expanded together
+            check_values = self.database.query(DBCMD.GET_STRUCT_VALUES, check_ids)
+            self.matcher = SubstructMatcher(zip(check_ids, check_values))
+            self.matcher_revision = revision
+        return self.matcher
+    
+    # Returns the symbol table of the symbol width, or None for 1-bit symbols
+    # Missing bit and byte structs are added, the table is made again whenever the structs were renumbered
+    def get_symbol_table(self):
+        if self.symbol_width == 1:
+            return None
+        epoch = self.database.query(DBCMD.GET_EPOCH)
+        if self.symbol_table is None or self.symbol_epoch != epoch:
+            bit_ids = np.array([self.symbol_id([bit]) for bit in (0, 1)], dtype=np.int64)
+            byte_bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).tolist()
+            byte_ids = np.array([self.symbol_id(bits) for bits in byte_bits], dtype=np.int64)
+            self.symbol_table = SymbolTable(self.symbol_width, bit_ids, byte_ids)
+            # Adding structs does not renumber them, only compaction can
+            self.symbol_epoch = self.database.query(DBCMD.GET_EPOCH)
+        return self.symbol_table
+    
+    # Returns the struct IDs of symbol codes, the structs of 16-bit symbols seen for the first time are added
+    def symbol_ids(self, codes):
+        symbol_table = self.get_symbol_table()
+        words = symbol_table.missing_words(codes)
+        if len(words):
+            byte_ids = symbol_table.ids[symbol_table.byte_offset:symbol_table.bit_offset]
+            symbol_table.ids[words] = self.database.query(DBCMD.ADD_STRUCT_PAIRS, byte_ids[words >> 8], byte_ids[words & 0xFF])
+        return symbol_table.ids[codes]
+    
+    # Returns the ID of the struct with the given values, adding it if there is none
+    def symbol_id(self, values):
+        struct = self.database.query(DBCMD.GET_STRUCT_BY_DATA, values)
+        if struct is None:
+            struct = self.database.query(DBCMD.ADD_STRUCT, StructContextual(values=values))
+        return struct.id
     
     # Finds all overlaps between a given struct's values and the given bit data and replaces the bit data with the struct's id
     def struct_overlap(self, struct, data):
-        cache_key = (struct.id, tuple(data))
-        if cache_key in self.struct_cache:
-            return self.struct_cache[cache_key]
-        result = self._struct_overlap(struct,data)
-        self.struct_cache[cache_key] = result
-        return result
-    
-    def _struct_overlap(self, struct, data):
         values = struct.get_values()
         length = len(values)
         new_data = []
@@ -176,10 +517,7 @@ class Catalog:
     
     # Gets all structs in the database which match the provided ids
     def structs_by_ids(self, ids):
-        structs = []
-        for id in ids:
-            structs.append(self.database.query(DBCMD.GET_STRUCT_BY_ID, id))
-        return structs
+        return self.database.query_batch(DBCMD.GET_STRUCT_BY_ID, ((id,) for id in ids))
 
     # Gets the struct which matches the given data
     def struct_by_data(self, structs, data):
@@ -1,12 +1,16 @@
-from collections import OrderedDict
 from enum import Enum, IntFlag
 import os
-from re import S
+import numpy as np
+from cache import MISSING, Cache
 from error_handler import handle_errors
-from file_io import read_bytes, write_bytes
+from file_io import append_bytes, map_file, write_bytes
+from index import IdRemap, SubstructIndex, ValueIndex, child_keys, combine_hashes, hash_children, hash_pairs, hash_values
+from metrics import metrics
+from relations import ContextRelations, make_features
 from serializer import to_bytes
-
-# TODO: Utilize ZStandard Compression
+from settings import Settings
+from store import StructStore
+from storage import FLAG_COMPRESSED, SDB_V1, SDB_V2, SDB_VERSION, SDBP_MAGIC, FrameRecords, LogRecords, PlainRecords, get_flags, get_version, log_headers, pack_compressed, pack_log_pointers, pack_log_substructs, pack_log_values, pack_pointers, pack_record, pack_remap_table, sdb_header, sdbr_header, sdbs_header, unpack_log_pointers, unpack_pointers, unpack_record, unpack_record_v1
 
 # Struct types
 class STYPE(Enum):
@@ -60,10 +64,12 @@ class StructBase:
         self.cached_substructs = structs
         return structs
     
-    def to_blueprint(self, full=False):
+    # The epoch is the number of database compactions so far, it lets the struct ID be resolved after later compactions
+    def to_blueprint(self, full=False, epoch=0):
         data = []
         data.append("SBP")
         data.append(self.id)
+        data.append(epoch)
         
         if full:
             for struct in self.substructs:
@@ -85,22 +91,30 @@ class StructData(StructBase):
         else:
             self.values = []
             
-        self.cached_values = None
+        self.length = None # Number of values with substructs expanded, computed from the substruct lengths
     
     # Returns the data that this struct represents
     def get_values(self):
         if self.values:
             return self.values
-        
-        values = []
-        if len(self.substructs) > 0:
-            if self.cached_values:
-                return self.cached_values
-            for struct in self.substructs:
-                values.extend(struct.get_values())
-                
-        self.cached_values = values
-        return values
+        return list(self.iter_values())
+    
+    # Yields the data that this struct represents without building the full list
+    def iter_values(self):
+        if self.values or not self.substructs:
+            yield from self.values
+            return
+        for struct in self.substructs:
+            yield from struct.iter_values()
+    
+    # Returns the number of values this struct represents
+    def get_length(self):
+        if self.length is None:
+            if self.values or not self.substructs:
+                self.length = len(self.values)
+            else:
+                self.length = sum(struct.get_length() for struct in self.substructs)
+        return self.length
     
     # Returns a copy of this struct
     def copy(self):
@@ -126,25 +140,28 @@ class StructPrimitive(StructData):
             self.base_struct,
             self.type)
     
-    def to_bytes(self, full=False):
+    # Returns the struct as a record in the given SDB format version
+    def to_bytes(self, full=False, version=SDB_VERSION):
+        substructs = self.get_substructs(full)
+        values = self.values
+        base_id = self.base_struct.id if self.base_struct else self.id
+        
+        if version == SDB_V2:
+            return pack_record(self.id, self.type.value, base_id, substructs, values)
+        
         data = []
         
         data.append(self.id)
         
-        substructs = self.get_substructs(full)
         data.append(len(substructs))
         data.extend(substructs)
         
         data.append(self.type.value)
         
-        values = self.values
         data.append(len(values))
         data.extend(values)
             
-        if self.base_struct:
-            data.append(self.base_struct.id)
-        else:
-            data.append(self.id)
+        data.append(base_id)
         
         return to_bytes(data)
         
@@ -177,85 +194,92 @@ class StructContextual(StructPrimitive):
     def set_context(self, context):
         self.context = context
     
-    # Updates count and distance
-    def update_general_relations(self):
-        for i, struct in enumerate(self.context):
-            # Incrementing count
-            if struct.values == self.values:
-                self.relations.count += 1
-            
-            # Getting distance between other structs
-            struct_pos = struct.position
-            self.relations.distances[struct_pos] = abs(struct_pos - self.position)
+    # Updates count and distance to the nearest structs in context
+    # Relations computed once for the whole context can be given, so every struct of a context is updated in linear time
+    def update_general_relations(self, context_relations=None):
+        if context_relations is None:
+            context_relations = ContextRelations.from_structs(self.context)
+        positions, distances, _ = context_relations.nearest(self.position, self.position + 1)
+        self.relations.count = int(context_relations.counts[self.position])
+        self.relations.positions = positions[0]
+        self.relations.distances = distances[0]
+        previous_same = int(context_relations.previous_same[self.position])
+        next_same = int(context_relations.next_same[self.position])
+        self.relations.same_distances = (
+            self.position - previous_same if previous_same >= 0 else 0,
+            next_same - self.position if next_same >= 0 else 0)
     
     # Updates count_diff, specific relations use other struct relations
-    def update_specific_relations(self):
-        for struct in self.context:
-            # Getting difference in struct counts
-            struct_count = struct.relations.count
-            self.relations.count_diff[struct.position] = struct_count - self.relations.count
+    def update_specific_relations(self, context_relations=None):
+        if context_relations is None:
+            context_relations = ContextRelations.from_structs(self.context)
+        self.relations.count_diff = context_relations.nearest(self.position, self.position + 1)[2][0]
     
     # Update context and general struct relations
-    def update_context(self, context):
+    def update_context(self, context, context_relations=None):
         self.set_context(context)
-        self.update_general_relations()
-        
-    def from_bytes(bytes):
-        id = int.from_bytes(bytes[:4])
-
-        substructs = []
-        # Each substruct is 4 bytes, separated by 4 zero bytes
-        substruct_count = int.from_bytes(bytes[8:12])
-        substructs_end = 16+(substruct_count*8)
-        if substruct_count > 0:
-            substructs_data = bytes[16:substructs_end]
-            while substructs_data:
-                substructs.append(int.from_bytes(substructs_data[:4]))
-                substructs_data = substructs_data[8:]
-        
-        type = STYPE(int.from_bytes(bytes[substructs_end:substructs_end+4]))
-        
-        values = []
-        value_count = int.from_bytes(bytes[substructs_end+8:substructs_end+12])
-        values_end = substructs_end+16+(value_count*8)
-        if value_count > 0:
-            values_data = bytes[substructs_end+16:values_end]
-            while values_data:
-                values.append(int.from_bytes(values_data[:4]))
-                values_data = values_data[8:]
-        
-        base_struct = int.from_bytes(bytes[values_end:values_end+4])
+        self.update_general_relations(context_relations)
         
+    # Decodes a struct from v1 bytes starting at offset, substructs are left as IDs
+    # Reads fields in place so large buffers (mmaps) are never sliced or copied
+    def from_bytes(bytes, offset=0):
+        return StructContextual.from_fields(unpack_record_v1(bytes, offset))
+    
+    # Decodes a struct from a v2 record starting at offset, substructs are left as IDs
+    def from_record(bytes, offset=0):
+        return StructContextual.from_fields(unpack_record(bytes, offset))
+    
+    # Makes a struct from unpacked record fields (id, type, base, substruct IDs, values)
+    def from_fields(fields):
+        id, type, base_struct, substructs, values = fields
         # TODO: type and base_struct (if necessary)
         return StructContextual(id, substructs, values)
 
 # The relationships a struct has with other structs
+# Relations are kept to the nearest structs in context only, see ContextRelations
 class StructRelations:
     def __init__(self):
+        empty = np.zeros(0, dtype=np.int32)
         self.count = 0 # How frequently the parent struct's values appear in context
-        self.distances = {} # Where the parent struct is, relative to other structs
-        self.count_diff = {} # Difference in how often the parent struct's values appear compared to other structs
+        self.positions = empty # Positions of the nearest structs in context
+        self.distances = empty # Where the parent struct is, relative to the structs at positions
+        self.count_diff = empty # Difference in how often the structs at positions appear compared to the parent struct
+        self.same_distances = (0, 0) # Distance to the previous and next struct with the same values, 0 if there is none
+    
+    # Returns the relation features of the parent struct, used to look up contextually equivalent structs in a RelationIndex
+    def features(self):
+        previous_distance, next_distance = self.same_distances
+        return make_features(
+            np.array([self.count]),
+            np.asarray(self.count_diff).reshape(1, -1),
+            np.array([previous_distance]),
+            np.array([next_distance]))[0]
         
     # Checks if current relations are equal to the given relations
+    # Only features relative to the struct's own position are compared, so equal structs can be anywhere in context
     def __eq__(self, other):
         if not isinstance(other, StructRelations):
             return False
         
         # Simple K-Nearest Neighbors for distance equivalence, k = 1 is good enough!
         k = 1
-        distance_differences = [abs(self.distances[key] - other.distances[key]) for key in self.distances.keys() & other.distances.keys()]
+        # Distances to the nearest structs, nearest first, compared rank by rank
+        shared = min(len(self.distances), len(other.distances))
+        distance_differences = np.abs(np.sort(self.distances)[:shared] - np.sort(other.distances)[:shared])
         # Sort and select top k smallest differences
-        sorted_differences = sorted(distance_differences)[:k]
+        sorted_differences = np.sort(distance_differences)[:k]
         # Average of k smallest differences
-        avg_difference = sum(sorted_differences) / k
+        avg_difference = sorted_differences.sum() / k
         # Threshold for equality
         threshold =  1.0
         distance_equal = avg_difference <= threshold
         
         return (
             self.count == other.count and
-            self.count_diff == other.count_diff and
-            distance_equal
+            np.array_equal(self.count_diff, other.count_diff) and
+            distance_equal and
+            # Whether there is a previous and next struct with the same values
+            [distance > 0 for distance in self.same_distances] == [distance > 0 for distance in other.same_distances]
         )
 
 # Points to a StructData for quick access to StructData/StructBase locations in byte data
@@ -274,87 +298,337 @@ class StructPointer:
         data.append(self.byteIndex)
         return to_bytes(data)
 
-# Caching for quick lookup of structs in the database
-class LRUCache:
-    def __init__(self, capacity):
-        self.cache = OrderedDict()
-        self.capacity = capacity
-    
-    def get(self, key):
-        if key not in self.cache:
+# Size of the v1 SDB and SDBP headers ("SDB"/"SDBP" + zero bytes)
+SDB_HEADER_SIZE = 7
+SDBP_HEADER_SIZE = 8
+# Each v1 pointer is a struct ID and a byte index, both followed by 4 zero bytes
+SDBP_POINTER_SIZE = 16
+# Bytes of decompressed frames kept in memory when reading a compressed database
+FRAME_CACHE_SIZE = 4 << 20
+# Bytes of owner lookups kept in memory, the struct made of each ordered list of substruct IDs
+OWNER_CACHE_SIZE = 1 << 20
+# Bytes of struct lookups by values kept in memory
+STRUCT_CACHE_SIZE = 1 << 20
+# Struct lookups by more values than this are not cached, hashing the values costs about as much as the lookup
+STRUCT_CACHE_MAX_VALUES = 256
+
+# A struct in a StructStore, made on request and holding nothing but the store and its ID
+# Reads like a StructContextual, substructs are views as well
+class StructView:
+    __slots__ = ('store', 'id')
+    
+    def __init__(self, store, id):
+        self.store = store
+        self.id = id
+    
+    def __eq__(self, other):
+        if isinstance(other, StructView):
+            return self.store is other.store and self.id == other.id
+        return isinstance(other, StructBase) and other.substructs == self.substructs
+    
+    @property
+    def type(self):
+        self.store.ensure(self.id)
+        return STYPE(int(self.store.types[self.id]))
+    
+    @property
+    def substructs(self):
+        return [StructView(self.store, id) for id in self.store.get_children(self.id).tolist()]
+    
+    @property
+    def values(self):
+        return self.store.get_values(self.id).tolist()
+    
+    @property
+    def base_struct(self):
+        self.store.ensure(self.id)
+        base = int(self.store.bases[self.id])
+        return None if base == self.id else StructView(self.store, base)
+    
+    @property
+    def relations(self):
+        return self.store.relations.setdefault(self.id, StructRelations())
+    
+    def get_substructs(self, full_tree=False, by_id=True):
+        if not full_tree and by_id:
+            return self.store.get_children(self.id).tolist()
+        structs = []
+        for substruct in self.substructs:
+            structs.append(substruct.id if by_id else substruct)
+            if full_tree:
+                structs.extend(substruct.get_substructs(full_tree, by_id))
+        return structs
+    
+    def get_values(self):
+        return self.store.expand(self.id)
+    
+    def iter_values(self):
+        return self.store.iter_values(self.id)
+    
+    # Yields the values as arrays, see StructStore.iter_value_chunks
+    def iter_value_chunks(self):
+        return self.store.iter_value_chunks(self.id)
+    
+    def get_length(self):
+        return self.store.length(self.id)
+    
+    # Returns the struct as a record in the given SDB format version
+    def to_bytes(self, full=False, version=SDB_VERSION):
+        return StructPrimitive.to_bytes(self, full, version)
+    
+    def to_blueprint(self, full=False, epoch=0):
+        return StructBase.to_blueprint(self, full, epoch)
+    
+    # Returns a standalone copy of this struct
+    def copy(self):
+        return StructContextual(
+            self.id,
+            self.substructs,
+            self.values,
+            self.base_struct,
+            struct_type=self.type)
+
+# List of structs kept in a StructStore, indexed by struct ID
+# Stored structs are only decoded from the database bytes the first time they are accessed
+# Structs are given out as StructViews, structs assigned or appended are copied into the store
+class LazyStructs:
+    def __init__(self, records=None, buffers=None):
+        self.store = StructStore(records)
+        self.records = records # Record reader of the database files
+        self.buffers = buffers or [] # Memory maps to close when released
+    
+    def __len__(self):
+        return len(self.store)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("Struct index out of range")
+        
+        # Views decode their struct again when it was unloaded, so decoded structs are unloaded here
+        self.store.trim()
+        self.store.ensure(index)
+        if self.store.is_empty(index):
             return None
-        self.cache.move_to_end(key)
-        return self.cache[key]
-    
-    def put(self, key, value):
-        if key in self.cache:
-            self.cache.move_to_end(key)
-        self.cache[key] = value
-        if len(self.cache) > self.capacity:
-            self.cache.popitem(last=False)
+        return StructView(self.store, index)
+    
+    def __setitem__(self, index, struct):
+        if index < 0:
+            index += len(self)
+        self.store.set(index, *self.fields(struct))
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+    # Appends a struct, None reserves an ID for a struct assigned later
+    def append(self, struct):
+        if struct is None:
+            self.store.reserve_id()
+        else:
+            self.store.add(*self.fields(struct))
+    
+    # Returns the (type, base, child IDs, values) of a struct to copy into the store
+    def fields(self, struct):
+        # Only primitive structs have a base struct
+        base_struct = getattr(struct, 'base_struct', None)
+        base = base_struct.id if base_struct else None
+        children = [substruct if isinstance(substruct, int) else substruct.id for substruct in struct.substructs]
+        return struct.type.value, base, children, struct.values
+    
+    # Decodes every stored struct into the store
+    def load_all(self):
+        self.store.load_all()
+        return self
+    
+    # Drops references to the database bytes and closes any memory maps
+    def release(self):
+        self.records = None
+        self.store.records = None
+        for buffer in self.buffers:
+            try:
+                buffer.close()
+            except BufferError:
+                # Still referenced elsewhere, closed once garbage collected
+                pass
+        self.buffers = []
 
 # The Struct Database File containing all database information
 class StructDatabase:
-    def __init__(self, ptrs=None, structs=None, cache_size=1000):
-        if ptrs and structs:
+    def __init__(self, ptrs=None, structs=None, owner_cache_size=OWNER_CACHE_SIZE, struct_cache_size=STRUCT_CACHE_SIZE, cache_admission=False):
+        if ptrs is not None and structs is not None:
             self.ptrs = ptrs
             self.structs = structs
         else:
             # Contains StructPointers, allows for quick access to StructData/StructBase locations in data
             self.ptrs = []
-            # Contains struct objects
-            # TODO: Implement queuing when adding structs and a temporary struct cache for commonly used structs during runtime and cataloging
-            self.structs = []
+            # Contains structs, kept as arrays in a StructStore
+            self.structs = LazyStructs()
         
-        self.substruct_index = {} # Maps substructs to parent struct
-        self.cache = LRUCache(cache_size)
+        self.version = SDB_VERSION # Format version of the loaded files
+        self.substruct_index = SubstructIndex() # Maps ordered substruct IDs to parent struct IDs
+        self.value_index = ValueIndex() # Maps value hashes to struct IDs
+        self.saved_count = len(self.structs) # Number of structs in the database files
+        self.replaced = set() # IDs of saved structs replaced since the last save
+        self.set_caches(owner_cache_size, struct_cache_size, cache_admission)
+    
+    # Makes new caches of owner lookups and struct lookups by values, owner lookups which found none are cached as None
+    # Owner entries are dropped when a struct which would change their result is added, all are dropped on replace or renumber
+    # The decoded cache bounds the bytes of stored structs kept decoded in memory, 0 keeps every decoded struct
+    def set_caches(self, owner_cache_size, struct_cache_size, admission=False, decoded_cache_size=0):
+        self.cache = Cache(owner_cache_size, 'substruct_owner', admission)
+        self.struct_cache = Cache(struct_cache_size, 'struct', admission)
+        self.structs.store.set_decoded_cache(decoded_cache_size, admission)
     
     # Get the struct that has the given data
     def get_struct(self, values):
+        cache_key = tuple(values) if len(values) <= STRUCT_CACHE_MAX_VALUES else None
+        id = MISSING if cache_key is None else self.struct_cache.get(cache_key, MISSING)
+        if id is MISSING:
+            id = next((struct.id for struct in self._structs_by_values(values) if self.values_equal(struct, values)), None)
+            # Only found structs are cached, adding a struct never changes them
+            if cache_key is not None and id is not None:
+                self.struct_cache.put(cache_key, id)
+        return None if id is None else self.structs[id].copy()
+    
+    # Compares the values of a struct to a list of values, stopping at the first difference
+    def values_equal(self, struct, values):
+        return (struct.get_length() == len(values) and
+                all(a == b for a, b in zip(struct.iter_values(), values)))
+    
+    # Yields the structs whose values have the same hash and length as the given values
+    def _structs_by_values(self, values):
+        self.ensure_value_index()
+        value_hash = hash_values(values)
+        for id in self.value_index.find(value_hash):
+            struct = self.structs[id]
+            # Entries of replaced structs can be stale, so the hash and length are checked again
+            if struct and self.get_value_hash(struct) == (value_hash, len(values)):
+                yield struct
+    
+    # Returns (value hash, value length) of a struct
+    # Unindexed structs are hashed from the hashes of their substructs
+    def get_value_hash(self, struct, use_index=True):
+        entry = self.value_index.get(struct.id) if use_index and struct.id is not None else None
+        if entry is not None:
+            return entry
+        if struct.values or not struct.substructs:
+            return hash_values(struct.values), len(struct.values)
+        return combine_hashes(self.get_value_hash(substruct) for substruct in struct.substructs)
+    
+    # Indexes every struct if the value index was missing when the database was loaded
+    def ensure_value_index(self):
+        if self.value_index.complete:
+            return
         for struct in self.structs:
-            if struct and struct.get_values() == values:
-                return struct.copy()
-        return None
+            if struct and self.value_index.get(struct.id) is None:
+                self.value_index.add(struct.id, *self.get_value_hash(struct))
+        self.value_index.complete = True
+    
+    # Indexes every struct if the substruct index was missing when the database was loaded
+    def ensure_substruct_index(self):
+        if not self.substruct_index.complete:
+            self.rebuild_substruct_index()
+    
+    # Indexes the substructs of every struct again, every struct is loaded
+    def rebuild_substruct_index(self):
+        self.structs.load_all()
+        self.substruct_index.release()
+        self.substruct_index = SubstructIndex.from_store(self.structs.store)
     
     def add_to_index(self, struct):
-        substruct_key = frozenset(struct.get_substructs(by_id=True))
-        if substruct_key not in self.substruct_index:
-            self.substruct_index[substruct_key] = []
-        self.substruct_index[substruct_key].append(struct)
-        
-    def get_from_index(self, substructs):
-        substruct_key = frozenset(substructs)
-        return self.substruct_index.get(substruct_key, [])
+        self.value_index.add(struct.id, *self.get_value_hash(struct, use_index=False))
+        self.add_substructs_to_index(struct)
+    
+    def add_substructs_to_index(self, struct):
+        substruct_ids = struct.get_substructs(by_id=True)
+        if substruct_ids:
+            self.substruct_index.add(struct.id, hash_children(substruct_ids))
+            self.cache.discard(tuple(substruct_ids))
+    
+    # Indexes new structs made of (left, right) pairs of substruct IDs, the pair keys are already hashed
+    def add_pairs_to_index(self, ids, left, right, keys):
+        value_index = self.value_index
+        for id, left_id, right_id, key in zip(ids.tolist(), left.tolist(), right.tolist(), keys.tolist()):
+            parts = (value_index.get(left_id), value_index.get(right_id))
+            if None in parts:
+                parts = [self.get_value_hash(self.structs[child]) for child in (left_id, right_id)]
+            value_index.add(id, *combine_hashes(parts))
+            self.substruct_index.add(id, key)
+            self.cache.discard((left_id, right_id))
+    
+    # Clears the substruct index after structs are renumbered, its keys hash the old substruct IDs
+    # It is indexed again when the database files are rewritten
+    def renumber_index(self):
+        self.substruct_index.release()
+        self.substruct_index = SubstructIndex()
+        self.substruct_index.complete = False
+        # Cached lookups hold the old IDs
+        self.clear_caches()
+    
+    # Drops every cached lookup, used when structs are replaced or renumbered
+    def clear_caches(self):
+        self.cache.clear()
+        self.struct_cache.clear()
     
     # Using the database cachce, gets the struct that has the given substructs
     def get_substructs_owner(self, substructs, ids=False):
-        cache_key = frozenset(substructs if ids else [struct.id for struct in substructs])
+        # Ordered key, (a, b) and (b, a) are owned by different structs
+        cache_key = tuple(substructs if ids else [struct.id for struct in substructs])
         
-        cached_result = self.cache.get(cache_key)
-        if cached_result:
+        # A cached None is a lookup which found no owner
+        cached_result = self.cache.get(cache_key, MISSING)
+        if cached_result is not MISSING:
             return cached_result
         
         result = self._get_substructs_owner_impl(substructs, ids)
-        if result:
-            self.cache.put(cache_key, result)
-            
+        self.cache.put(cache_key, result)
         return result
     
     # Get the struct that has the given substructs
     def _get_substructs_owner_impl(self, substructs, ids=False):
-        substruct_ids = substructs if ids else [struct.id for struct in substructs]
-        matching_structs = self.get_from_index(substruct_ids)
-        
-        for struct in matching_structs:
-            # If all substruct IDs are matching
-            if struct.get_substructs() == substruct_ids:
-                return struct.copy()
-            
+        substruct_ids = list(substructs) if ids else [struct.id for struct in substructs]
+        self.ensure_substruct_index()
+        id = self._find_owner(hash_children(substruct_ids), substruct_ids)
+        return None if id is None else self.structs[id]
+    
+    # Returns the ID of the struct with the given key and substruct IDs, or None
+    def _find_owner(self, key, substruct_ids):
+        store = self.structs.store
+        for id in self.substruct_index.find(key):
+            # Keys are hashes and replaced structs keep their old keys, so the substructs are compared
+            store.ensure(id)
+            if not store.is_empty(id) and store.get_children(id).tolist() == substruct_ids:
+                return id
         return None
     
+    # Returns the ID of the struct made of each (left, right) pair of substruct IDs, -1 for pairs without one
+    def get_pair_owners(self, left, right):
+        self.ensure_substruct_index()
+        self.structs.store.trim()
+        keys = hash_pairs(left, right)
+        stored = self.substruct_index.find_stored(keys)
+        owners = stored.copy()
+        found = np.flatnonzero(owners >= 0)
+        if len(found):
+            matching = self.structs.store.has_pairs(owners[found], left[found], right[found])
+            owners[found[~matching]] = -1
+        # Only pairs whose key is also held by other stored structs (replaced structs or hash collisions)
+        # or by structs added since loading are looked up one by one, the rest have no owner
+        missing = np.flatnonzero(owners < 0)
+        missing = missing[(stored[missing] >= 0) | self.substruct_index.has_added(keys[missing])]
+        for i in missing.tolist():
+            id = self._find_owner(int(keys[i]), [int(left[i]), int(right[i])])
+            if id is not None:
+                owners[i] = id
+        return owners, keys
+    
     # Get the id of a struct by data
     def get_id(self, values):
-        for struct in self.structs:
+        for struct in self._structs_by_values(values):
             if struct.values == values:
                 return struct.id
         return None
@@ -371,14 +645,17 @@ class StructDatabase:
         
     # Gets all structs with values of a given length
     def get_structs_length(self, length):
-        structs = []
-        for struct in self.structs:
-            if len(struct.get_values()) == length:
-                structs.append(struct)
-        return structs
+        self.ensure_value_index()
+        return [self.structs[id] for id in self.value_index.find_length(length)]
     
     # Returns the byte data for the Database and Pointers files
-    def to_sdb(self):
+    # v2 databases are compressed in blocks when a compression level above 0 is given
+    def to_sdb(self, version=SDB_VERSION, compression_level=0, block_size=1 << 16, dict_size=0):
+        if version == SDB_V2:
+            if compression_level > 0:
+                return self._to_sdb_compressed(compression_level, block_size, dict_size)
+            return self._to_sdb_v2()
+        
         # Database data
         db_data = []
         db_data.append("SDB")
@@ -389,7 +666,7 @@ class StructDatabase:
         for struct in self.structs:
             # Next byte will be the start of structs data
             ptrs.append(StructPointer(struct.id, next_byte))
-            struct_data = struct.to_bytes()
+            struct_data = struct.to_bytes(version=SDB_V1)
             byte_data.extend(struct_data)
             next_byte += len(struct_data)
         
@@ -400,43 +677,88 @@ class StructDatabase:
             ptr_file_data.extend(ptr.to_bytes())
         
         return bytes(byte_data), bytes(ptr_file_data)
+    
+    # v2 files have no padding, the pointer file is a pair of arrays (byte indexes, IDs)
+    def _to_sdb_v2(self):
+        byte_data = bytearray(sdb_header())
+        ids = []
+        byte_indexes = []
+        for struct in self.structs:
+            ids.append(struct.id)
+            byte_indexes.append(len(byte_data))
+            byte_data.extend(struct.to_bytes(version=SDB_V2))
+        
+        return bytes(byte_data), bytes(pack_pointers(ids, byte_indexes))
+    
+    # Compressed v2 files store each block of structs as an independent zstd frame
+    # The pointer file records the frame of each struct and its byte index inside the frame
+    def _to_sdb_compressed(self, level, block_size, dict_size):
+        ids = [struct.id for struct in self.structs]
+        records = [struct.to_bytes(version=SDB_V2) for struct in self.structs]
+        byte_data, frames, byte_indexes, frame_indexes = pack_compressed(records, level, block_size, dict_size)
+        return bytes(byte_data), bytes(pack_pointers(ids, byte_indexes, frames, frame_indexes))
 
+    # Returns a database which lazily decodes structs from the given bytes
+    # Reads v1 and v2 files
     @handle_errors
-    def from_bytes(db_bytes, ptrs_bytes):
-        # Match "SDB" and "SDBP"
-        db_str = db_bytes[:3].decode('utf-8')
-        ptrs_str = ptrs_bytes[:4].decode('utf-8')
-        if db_str == "SDB" and ptrs_str == "SDBP":
-            ptrs = []
-            # Skip header
-            ptrs_data = ptrs_bytes[8:]
-            while ptrs_data:
-                # Each data point is separated by 4 zero bytes
-                pointer = StructPointer.from_bytes(ptrs_data[:12])
-                ptrs.append(pointer)
-                ptrs_data = ptrs_data[16:]  # Move to the next StructPointer data
-            
-            structs = []
-            for i, ptr in enumerate(ptrs):
-                if i+1 >= len(ptrs):
-                    struct_data = db_bytes[ptr.byteIndex:]
-                else:
-                    next_struct = ptrs[i+1].byteIndex
-                    struct_data = db_bytes[ptr.byteIndex:next_struct-4]
-                
-                struct = StructContextual.from_bytes(struct_data)
-                structs.append(struct)
-            
-            # Replace substruct IDs with struct references
-            for struct in structs:
-                substructs = []
-                for substruct_id in struct.substructs:
-                    substructs.append(structs[substruct_id])
-                struct.substructs = substructs
-            
-            return StructDatabase(ptrs, structs)
+    def from_bytes(db_bytes, ptrs_bytes, buffers=None, frame_cache_size=FRAME_CACHE_SIZE):
+        version = get_version(db_bytes)
+        if get_version(ptrs_bytes, SDBP_MAGIC) != version:
+            raise ValueError("Database and Pointer file versions do not match.")
+        
+        if version == SDB_V1:
+            # Decode the whole pointer table at once, each pointer is (ID, 0, byte index, 0)
+            ptr_count = (len(ptrs_bytes) - SDBP_HEADER_SIZE) // SDBP_POINTER_SIZE
+            ptrs = np.frombuffer(ptrs_bytes, dtype='>u4', count=ptr_count * 4, offset=SDBP_HEADER_SIZE).reshape(-1, 4)[:, ::2]
+            structs = LazyStructs(PlainRecords(db_bytes, ptrs[:, 1], unpack_record_v1), buffers)
+        elif version == SDB_V2:
+            ids, byte_indexes, frames, frame_indexes = unpack_pointers(ptrs_bytes)
+            ptrs = (ids, byte_indexes)
+            if get_flags(db_bytes) & FLAG_COMPRESSED:
+                records = FrameRecords(db_bytes, byte_indexes, frames, frame_indexes, Cache(frame_cache_size, 'frame', sizeof=lambda frame, frame_data: len(frame_data)))
+            else:
+                records = PlainRecords(db_bytes, byte_indexes)
+            structs = LazyStructs(records, buffers)
         else:
-            raise ValueError("Invalid Database or Pointer file.")
+            raise ValueError(f"Unsupported Database version: {version}")
+        
+        database = StructDatabase(ptrs, structs)
+        database.version = version
+        return database
+    
+    # Memory maps the Database and Pointers files and lazily loads structs from them
+    @handle_errors
+    def from_files(sdb_path, ptrs_path, frame_cache_size=FRAME_CACHE_SIZE):
+        db_map = map_file(sdb_path)
+        if not db_map:
+            return StructDatabase()
+        ptrs_map = map_file(ptrs_path)
+        if not ptrs_map:
+            raise ValueError("Failed to load pointers for database.")
+        return StructDatabase.from_bytes(db_map, ptrs_map, [db_map, ptrs_map], frame_cache_size)
+    
+    # Reads the structs saved in the append-only log on top of the structs in the base files
+    @handle_errors
+    def load_log(self, log_path, log_ptrs_path):
+        log_map = map_file(log_path) if os.path.exists(log_path) else None
+        log_ptrs_map = map_file(log_ptrs_path) if os.path.exists(log_ptrs_path) else None
+        if not log_map or not log_ptrs_map:
+            return
+        ids, byte_indexes = unpack_log_pointers(log_ptrs_map)
+        if len(ids) == 0:
+            return
+        
+        base, buffers = self.structs.records, self.structs.buffers
+        self.structs = LazyStructs(LogRecords(base, log_map, ids, byte_indexes), buffers + [log_map, log_ptrs_map])
+        self.saved_count = len(self.structs)
+    
+    # Decodes all lazily loaded structs and releases the underlying files
+    def load_all(self):
+        self.structs.load_all().release()
+        self.ptrs = []
+
+# Extensions of the files a Database keeps in its directory
+DATABASE_EXTENSIONS = ('.sdb', '.sdbp', '.sdbh', '.sdbs', '.sdbl', '.sdbpl', '.sdbhl', '.sdbsl', '.sdbr')
 
 # Database commands
 class DBCMD(IntFlag):
@@ -458,16 +780,39 @@ class DBCMD(IntFlag):
     
     # Others
     SAVE_DB = 1 << 12
+    MIGRATE_DB = 1 << 13
+    GET_REVISION = 1 << 14
+    ADD_STRUCT_PAIRS = 1 << 15
+    COMPACT_DB = 1 << 16
+    GET_EPOCH = 1 << 17
+    GET_BLUEPRINT_STRUCT = 1 << 18
+    GET_STRUCT_VALUES = 1 << 19
 
 # Container and handler which gets and sets data in the Struct Database File
 class Database():
     @handle_errors
-    def __init__(self, path):
+    def __init__(self, path, settings=None):
         self.working_dir = path
+        self.settings = settings or Settings(None)
+        # Dispatch table of command handlers
+        self.handlers = {cmd: getattr(self, name) for cmd, name in self.CMDHANDLERS.items()}
+        # Argument validation can be turned off in production
+        self.validate = self.settings.validate_queries
         # Struct Database file containing all the structures
         self.sdb_path = os.path.join(self.working_dir, 'database.sdb')
         # Pointers file containing location data for individual structures, relevant for looking up stuff from the database file (quickly).
         self.ptrs_path = os.path.join(self.working_dir, 'pointers.sdbp')
+        # Value hash index file, maps struct values to struct IDs
+        self.values_path = os.path.join(self.working_dir, 'values.sdbh')
+        # Substruct index file, maps the ordered substruct IDs of structs to struct IDs
+        self.substructs_path = os.path.join(self.working_dir, 'substructs.sdbs')
+        # Append-only logs of the structs saved since the files above were last rewritten
+        self.log_path = os.path.join(self.working_dir, 'database.sdbl')
+        self.log_ptrs_path = os.path.join(self.working_dir, 'pointers.sdbpl')
+        self.log_values_path = os.path.join(self.working_dir, 'values.sdbhl')
+        self.log_substructs_path = os.path.join(self.working_dir, 'substructs.sdbsl')
+        # Struct ID remap tables written by each compaction
+        self.remap_path = os.path.join(self.working_dir, 'remap.sdbr')
         
         # Init database
         if not os.path.exists(self.sdb_path):
@@ -476,15 +821,28 @@ class Database():
         if not os.path.exists(self.ptrs_path):
             write_bytes(self.ptrs_path)
         
-        db_bytes = read_bytes(self.sdb_path)
-        if db_bytes:
-            ptrs_bytes = read_bytes(self.ptrs_path)
-            if ptrs_bytes:
-                self.struct_db = StructDatabase.from_bytes(db_bytes, ptrs_bytes)
-            else:
-                raise ValueError("Failed to load pointers for database.")
-        else:
-            self.struct_db = StructDatabase()
+        # Structs are decoded from the memory mapped files when first accessed
+        self.struct_db = StructDatabase.from_files(self.sdb_path, self.ptrs_path, self.settings.compression_cache_size)
+        value_index = ValueIndex.from_file(self.values_path, len(self.struct_db.structs))
+        substruct_index = SubstructIndex.from_file(self.substructs_path, len(self.struct_db.structs))
+        # Number of structs in the base files, the log holds the rest
+        self.base_count = len(self.struct_db.structs)
+        self.struct_db.load_log(self.log_path, self.log_ptrs_path)
+        self.struct_db.set_caches(self.settings.owner_cache_size, self.settings.struct_cache_size, self.settings.cache_admission, self.settings.decoded_cache_size)
+        if os.path.exists(self.log_path) and not os.path.exists(self.log_substructs_path):
+            # Logs written before the substruct log existed are indexed again from the structs
+            substruct_index.complete = False
+        substruct_index.load_log(self.log_substructs_path)
+        self.struct_db.substruct_index = substruct_index
+        value_index.load_log(self.log_values_path)
+        value_index.complete = value_index.complete and value_index.size() >= len(self.struct_db.structs)
+        self.struct_db.value_index = value_index
+        # Lengths of stored structs are known without decoding them
+        if value_index.complete:
+            self.struct_db.structs.store.seed_lengths(value_index.arrays()[1])
+        self.id_remap = IdRemap.from_file(self.remap_path)
+        # Incremented whenever structs are added, replaced or renumbered
+        self.revision = 0
         
     CMDARGS = {
         DBCMD.GET_NEW_ID: (1, [bool]),
@@ -500,6 +858,37 @@ class Database():
         DBCMD.SET_STRUCT: (2, [int, object]),
         DBCMD.ADD_STRUCT: (1, [object]),
         DBCMD.SAVE_DB: (0, []),
+        DBCMD.MIGRATE_DB: (1, [int]),
+        DBCMD.GET_REVISION: (0, []),
+        DBCMD.ADD_STRUCT_PAIRS: (2, [object, object]),
+        DBCMD.COMPACT_DB: (0, []),
+        DBCMD.GET_EPOCH: (0, []),
+        DBCMD.GET_BLUEPRINT_STRUCT: (1, [object]),
+        DBCMD.GET_STRUCT_VALUES: (1, [object]),
+    }
+    
+    # Method handling each command
+    CMDHANDLERS = {
+        DBCMD.GET_NEW_ID: '__getNewID__',
+        DBCMD.GET_STRUCT_DATA: '__getStructData__',
+        DBCMD.GET_STRUCT_BY_ID: '__getStructByID__',
+        DBCMD.GET_STRUCT_BY_DATA: '__getStructByData__',
+        DBCMD.GET_STRUCT_BY_SUBSTRUCTS: '__getStructBySubstructs__',
+        DBCMD.GET_STRUCTS_BY_LENGTH: '__getStructsByLength__',
+        DBCMD.GET_SUBSTRUCT_IDS: '__getSubstructIDs__',
+        DBCMD.GET_STRUCTS: '__getStructs__',
+        DBCMD.GET_BLUEPRINT_BYTES: '__getBlueprintBytes__',
+        DBCMD.SET_DATA: '__setData__',
+        DBCMD.SET_STRUCT: '__setStruct__',
+        DBCMD.ADD_STRUCT: '__addStruct__',
+        DBCMD.SAVE_DB: '__saveDB__',
+        DBCMD.MIGRATE_DB: '__migrateDB__',
+        DBCMD.GET_REVISION: '__getRevision__',
+        DBCMD.ADD_STRUCT_PAIRS: '__addStructPairs__',
+        DBCMD.COMPACT_DB: '__compactDB__',
+        DBCMD.GET_EPOCH: '__getEpoch__',
+        DBCMD.GET_BLUEPRINT_STRUCT: '__getBlueprintStruct__',
+        DBCMD.GET_STRUCT_VALUES: '__getStructValues__',
     }
 
     # Gets and reserves the next ID for a new struct
@@ -529,6 +918,10 @@ class Database():
     def __getStructBySubstructs__(self, substructs, ids=False):
         return self.struct_db.get_substructs_owner(substructs, ids)
 
+    # Retrieve all structs
+    def __getStructs__(self):
+        return self.struct_db.structs
+    
     # Retrieve structs by value length
     def __getStructsByLength__(self, length):
         return self.struct_db.get_structs_length(length)
@@ -538,22 +931,56 @@ class Database():
         return self.struct_db.structs[id].substructs
     
     # Returns the byte data of the struct referenced by ID in a blueprint
-    def __getBlueprintBytes(self, bytes):
-        data = bytes[7:]
-        # Get all substruct IDs
-        struct_id = int.from_bytes(data)
-        struct = self.struct_db.structs[struct_id]
-        return struct.get_values()
+    def __getBlueprintBytes__(self, bytes):
+        return self.__getBlueprintStruct__(bytes).get_values()
+    
+    # Returns the struct referenced by ID in a blueprint, its values can be streamed with iter_value_chunks
+    def __getBlueprintStruct__(self, bytes):
+        # "SBP", struct ID and epoch, each followed by 4 zero bytes
+        struct_id = int.from_bytes(bytes[7:11], 'big')
+        # Blueprints written before epochs were added have no epoch
+        epoch = int.from_bytes(bytes[15:19], 'big') if len(bytes) >= 19 else 0
+        return self.struct_db.structs[self.id_remap.resolve(struct_id, epoch)]
+    
+    # Retrieve the number of compactions of the database, blueprints store it to resolve their struct IDs
+    def __getEpoch__(self):
+        return self.id_remap.epoch()
+    
+    # Retrieve the values of many structs by ID at once
+    def __getStructValues__(self, ids):
+        return self.struct_db.structs.store.expand_many(ids)
+    
+    # Retrieve the revision of the database, changes whenever structs are added, replaced or renumbered
+    def __getRevision__(self):
+        return self.revision
     
     # Assigns data to a given ID
     def __setData__(self, id, data):
         struct = self.struct_db.structs[id]
         if struct.type != STYPE.DATA:
             self.struct_db.structs[id] = StructData(id, struct.substructs, data)
+            self.__reindexValues__(id)
+            self.__markReplaced__(id)
     
     # Assigns a struct to a given ID
     def __setStruct__(self, id, struct):
         self.struct_db.structs[id] = struct
+        self.__reindexValues__(id)
+        self.__markReplaced__(id)
+    
+    # Saved structs which are replaced are appended to the log again on the next save
+    def __markReplaced__(self, id):
+        if id < self.struct_db.saved_count:
+            self.struct_db.replaced.add(id)
+    
+    # Updates the value index entry of a replaced struct
+    def __reindexValues__(self, id):
+        struct = self.struct_db.structs[id]
+        self.struct_db.value_index.add(id, *self.struct_db.get_value_hash(struct, use_index=False))
+        self.struct_db.add_substructs_to_index(struct)
+        # Cached lookups can still hold the old substructs or values of the struct
+        self.struct_db.clear_caches()
+        self.revision += 1
     
     # Adds a new struct to the database and sets its ID
     # Returns an existing struct or the new struct
@@ -562,31 +989,176 @@ class Database():
             # Check if data belongs to existing struct
             existing = self.struct_db.get_substructs_owner(struct.get_substructs(), ids=True)
             if existing:
+                metrics.count('structs_deduplicated')
                 return existing
         
+        metrics.count('structs_created')
         struct.id = self.__getNewID__(append=False)
         self.struct_db.structs.append(struct)
+        struct = self.struct_db.structs[struct.id]
         self.struct_db.add_to_index(struct)
+        self.revision += 1
         return struct
     
+    # Adds the structs made of each (left, right) pair of substruct IDs, given as two arrays
+    # Returns an array with the ID of the existing or new struct for each pair
+    # Each distinct pair is looked up once, new structs get IDs in order of their first appearance
+    def __addStructPairs__(self, left, right):
+        left = np.asarray(left, dtype=np.uint64)
+        right = np.asarray(right, dtype=np.uint64)
+        keys = (left << np.uint64(32)) | right
+        unique_keys, first_indexes, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        
+        unique_left = unique_keys >> np.uint64(32)
+        unique_right = unique_keys & np.uint64(0xFFFFFFFF)
+        owners, pair_keys = self.struct_db.get_pair_owners(unique_left, unique_right)
+        
+        # New structs are added to the store in one go
+        new_pairs = np.flatnonzero(owners < 0)
+        if len(new_pairs):
+            new_pairs = new_pairs[np.argsort(first_indexes[new_pairs], kind='stable')]
+            first_id = self.struct_db.structs.store.add_pairs(
+                STYPE.CONTEXTUAL.value, unique_left[new_pairs], unique_right[new_pairs])
+            new_ids = np.arange(first_id, first_id + len(new_pairs))
+            owners[new_pairs] = new_ids
+            self.struct_db.add_pairs_to_index(new_ids, unique_left[new_pairs], unique_right[new_pairs], pair_keys[new_pairs])
+        metrics.count('structs_created', len(new_pairs))
+        metrics.count('structs_deduplicated', len(left) - len(new_pairs))
+        
+        self.revision += 1
+        return owners[inverse.reshape(-1)]
+    
     # Saves the Struct Database file
+    # With append saves enabled, new and replaced structs are appended to the log, otherwise the files are rewritten
+    # Every struct ID stays the same, structs are only renumbered by an explicit compaction
     def __saveDB__(self):
-        # Sort structs in the database by length and modify their ids accordingly
-        sorted_structs = sorted(self.struct_db.structs, key=lambda x: len(x.get_values()))
-        for i, struct in enumerate(sorted_structs):
-            struct.id = i
-        self.struct_db.structs = sorted_structs
-        
-        # Save to files
-        database_file, ptrs_file = self.struct_db.to_sdb()
+        with metrics.timer('save'):
+            if self.settings.append_saves:
+                self.__appendDB__()
+            else:
+                self.__rewriteDB__()
+    
+    # Rewrites the database files with every struct, struct IDs are kept as they are
+    def __rewriteDB__(self):
+        # Every struct is needed in memory before the files are rewritten
+        self.struct_db.load_all()
+        self.__writeDB__(SDB_VERSION)
+    
+    # Folds the log into the base files and sorts the structs added since the last compaction by length
+    # Structs compacted before keep their IDs, so each struct is renumbered once at most and the remap file
+    # only grows by the structs added between compactions
+    # Records the new ID of every moved ID, so blueprints written before the compaction still resolve
+    def __compactDB__(self):
+        self.struct_db.load_all()
+        
+        # Sort the new structs by length and modify their ids accordingly
+        # The sort is stable so equal lengths keep their order
+        self.struct_db.ensure_value_index()
+        first = self.id_remap.compacted_count()
+        lengths = self.struct_db.structs.store.all_lengths()
+        old_ids = np.arange(len(lengths))
+        old_ids[first:] = first + np.argsort(lengths[first:], kind='stable')
+        # Structs at the start which keep their ID are left out of the table
+        moved = np.flatnonzero(old_ids[first:] != np.arange(first, len(old_ids)))
+        first = first + int(moved[0]) if len(moved) else len(old_ids)
+        if first < len(old_ids):
+            self.struct_db.value_index.remap(old_ids)
+            new_ids = self.struct_db.structs.store.reorder(old_ids)
+            self.struct_db.renumber_index()
+            self.revision += 1
+        else:
+            new_ids = old_ids
+        self.__writeDB__(SDB_VERSION)
+        
+        if not os.path.exists(self.remap_path) or os.path.getsize(self.remap_path) == 0:
+            write_bytes(self.remap_path, sdbr_header())
+        append_bytes(self.remap_path, pack_remap_table(new_ids[first:], first))
+        self.id_remap.add(new_ids[first:], first)
+        print(f"Compacted Database, epoch {self.id_remap.epoch()}")
+    
+    # Appends the structs added or replaced since the last save to the log files
+    def __appendDB__(self):
+        struct_db = self.struct_db
+        ids = sorted(struct_db.replaced) + list(range(struct_db.saved_count, len(struct_db.structs)))
+        if not ids:
+            return
+        
+        headers = log_headers()
+        log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        if log_size == 0:
+            # New log files start with their headers
+            for path, header in zip((self.log_path, self.log_ptrs_path, self.log_values_path), headers):
+                write_bytes(path, header)
+            log_size = len(headers[0])
+        
+        substruct_ids = ids
+        if not os.path.exists(self.log_substructs_path):
+            write_bytes(self.log_substructs_path, sdbs_header())
+            # Structs already in a log written before the substruct log existed are added to it as well
+            substruct_ids = list(range(self.base_count, struct_db.saved_count)) + ids
+        
+        records = []
+        byte_indexes = []
+        value_entries = []
+        for id in ids:
+            struct = struct_db.structs[id]
+            record = struct.to_bytes(version=SDB_V2)
+            byte_indexes.append(log_size)
+            log_size += len(record)
+            records.append(record)
+            value_entry = struct_db.value_index.get(id)
+            if value_entry is None:
+                value_entry = struct_db.get_value_hash(struct)
+            value_entries.append(value_entry)
+        
+        # Records are written before the pointers to them, an interrupted save leaves the log readable
+        append_bytes(self.log_path, b''.join(records))
+        append_bytes(self.log_ptrs_path, pack_log_pointers(ids, byte_indexes))
+        hashes, lengths = zip(*value_entries)
+        append_bytes(self.log_values_path, pack_log_values(ids, hashes, lengths))
+        append_bytes(self.log_substructs_path, pack_log_substructs(*child_keys(struct_db.structs.store, np.array(substruct_ids, dtype=np.int64))))
+        print(f"Appended {len(ids)} structs to log:", self.log_path)
+        
+        struct_db.saved_count = len(struct_db.structs)
+        struct_db.replaced = set()
+    
+    # Writes the Database and Pointers files in the given format version
+    def __writeDB__(self, version):
+        database_file, ptrs_file = self.struct_db.to_sdb(
+            version,
+            self.settings.compression_level,
+            self.settings.compression_block_size,
+            self.settings.compression_dict_size)
         write_bytes(self.sdb_path, database_file)
         print("Saved Database to file:", self.sdb_path)
         write_bytes(self.ptrs_path, ptrs_file)
         print("Saved Pointers to file:", self.ptrs_path)
+        self.struct_db.ensure_value_index()
+        self.struct_db.value_index.detach()
+        write_bytes(self.values_path, self.struct_db.value_index.to_bytes())
+        self.struct_db.rebuild_substruct_index()
+        write_bytes(self.substructs_path, self.struct_db.substruct_index.to_bytes())
+        self.base_count = len(self.struct_db.structs)
+        self.struct_db.version = version
+        self.struct_db.saved_count = len(self.struct_db.structs)
+        self.struct_db.replaced = set()
+        
+        # The log is part of the rewritten files now
+        for path in (self.log_path, self.log_ptrs_path, self.log_values_path, self.log_substructs_path):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    # Rewrites the database files in another format version, struct IDs are kept as they are
+    def __migrateDB__(self, version):
+        if version not in (SDB_V1, SDB_V2):
+            raise ValueError(f"Unsupported Database version: {version}")
+        self.struct_db.load_all()
+        print(f"Migrating Database from v{self.struct_db.version} to v{version}")
+        self.__writeDB__(version)
         
     # Checks if command + arguments are valid
     def __checkCMD__(self, cmd, args):
-        if cmd not in self.CMDARGS:
+        if cmd not in self.CMDARGS or cmd not in self.handlers:
             raise ValueError('Invalid command')
 
         expected_arg_count, expected_types = self.CMDARGS[cmd]
@@ -600,31 +1172,19 @@ class Database():
     @handle_errors
     # Handles database commands
     def query(self, cmd, *args):
-        self.__checkCMD__(cmd, args)
-        
-        if cmd == DBCMD.GET_NEW_ID:
-            return self.__getNewID__(args[0])
-        elif cmd == DBCMD.GET_STRUCT_DATA:
-            return self.__getStructData__(args[0])
-        elif cmd == DBCMD.GET_STRUCT_BY_ID:
-            return self.__getStructByID__(args[0])
-        elif cmd == DBCMD.GET_STRUCT_BY_DATA:
-            return self.__getStructByData__(args[0])
-        elif cmd == DBCMD.GET_STRUCT_BY_SUBSTRUCTS:
-            return self.__getStructBySubstructs__(args[0], args[1])
-        elif cmd == DBCMD.GET_STRUCTS_BY_LENGTH:
-            return self.__getStructsByLength__(args[0])
-        elif cmd == DBCMD.GET_SUBSTRUCT_IDS:
-            return self.__getSubstructIDs__(args[0])
-        elif cmd == DBCMD.GET_STRUCTS:
-            return self.struct_db.structs
-        elif cmd == DBCMD.GET_BLUEPRINT_BYTES:
-            return self.__getBlueprintBytes(args[0])
-        elif cmd == DBCMD.SET_DATA:
-            return self.__setData__(args[0], args[1])
-        elif cmd == DBCMD.SET_STRUCT:
-            return self.__setStruct__(args[0], args[1])
-        elif cmd == DBCMD.ADD_STRUCT:
-            return self.__addStruct__(args[0])
-        elif cmd == DBCMD.SAVE_DB:
-            return self.__saveDB__()
\ No newline at end of file
+        if self.validate:
+            self.__checkCMD__(cmd, args)
+        return self.handlers[cmd](*args)
+    
+    @handle_errors
+    # Handles many database commands of the same kind, each item of args_list is the arguments of one command
+    # Returns a list with the result of each command
+    def query_batch(self, cmd, args_list):
+        handler = self.handlers[cmd]
+        if self.validate:
+            results = []
+            for args in args_list:
+                self.__checkCMD__(cmd, args)
+                results.append(handler(*args))
+            return results
+        return [handler(*args) for args in args_list]
\ No newline at end of file
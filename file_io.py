@@ -1,29 +1,136 @@
+import mmap
 import os
+import numpy as np
 from error_handler import handle_errors
 
 BYTE_BITS = 8
+# Widths (in bits) of the symbols data can be catalogued in, 1 matches bits against the lowest structs
+SYMBOL_WIDTHS = (1, 8, 16)
+# Number of packed bytes unpacked at a time while iterating over a BitArray
+ITER_CHUNK_BYTES = 1 << 16
+
+# A packed sequence of bits which indexes and slices like a list of bits
+# Stores 1 bit per bit, backed by a bytes-like object (bytes, bytearray, mmap, numpy array)
+class BitArray:
+    def __init__(self, packed=None, length=None):
+        if packed is None:
+            packed = np.zeros(0, dtype=np.uint8)
+        elif not isinstance(packed, np.ndarray):
+            packed = np.frombuffer(packed, dtype=np.uint8)
+        self.packed = packed
+        self.length = len(packed) * BYTE_BITS if length is None else length
+    
+    # Packs a list of bits into a BitArray
+    def from_bits(bits):
+        bits = np.asarray(bits, dtype=np.uint8)
+        return BitArray(np.packbits(bits), len(bits))
+    
+    def __len__(self):
+        return self.length
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if start >= stop:
+                return []
+            # Only unpack the bytes covering the slice
+            first_byte = start // BYTE_BITS
+            last_byte = (stop + BYTE_BITS - 1) // BYTE_BITS
+            bits = np.unpackbits(self.packed[first_byte:last_byte])
+            offset = first_byte * BYTE_BITS
+            return bits[start - offset:stop - offset:step].tolist()
+        
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError("BitArray index out of range")
+        return int(self.packed[index >> 3] >> (7 - (index & 7))) & 1
+    
+    def __iter__(self):
+        for i in range(0, len(self.packed), ITER_CHUNK_BYTES):
+            bits = np.unpackbits(self.packed[i:i+ITER_CHUNK_BYTES])
+            remaining = self.length - i * BYTE_BITS
+            yield from bits[:remaining].tolist()
+    
+    def __eq__(self, other):
+        if isinstance(other, BitArray):
+            return self.length == other.length and np.array_equal(self.unpack(), other.unpack())
+        try:
+            return self.length == len(other) and np.array_equal(self.unpack(), np.asarray(other))
+        except TypeError:
+            return False
+    
+    # Returns the bits as a numpy array of 0s and 1s
+    def unpack(self):
+        return np.unpackbits(self.packed, count=self.length)
+    
+    # Returns the bits as a list of ints
+    def tolist(self):
+        return self.unpack().tolist()
+    
+    # Returns the packed bytes, the final byte is padded with zero bits
+    def tobytes(self):
+        return self.packed[:(self.length + BYTE_BITS - 1) // BYTE_BITS].tobytes()
 
 # TODO: Multithreaded file IO
+# Reads a file as bits, packed reads memory map the file and return a BitArray instead of a list
+@handle_errors
+def read_bits(file_path, packed=False):
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return BitArray() if packed else []
+        if packed:
+            return BitArray(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        data = np.frombuffer(file.read(), dtype=np.uint8)
+    return np.unpackbits(data).tolist()
+
+# Reads a file as packed bits one window of window_size bytes at a time
+# Only the current window is held in memory
+def read_bit_windows(file_path, window_size):
+    with open(file_path, 'rb') as file:
+        while True:
+            data = file.read(window_size)
+            if not data:
+                break
+            yield BitArray(data)
+
+# Buffer size of streamed writes, in bytes
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Writes bits given as a sequence of arrays of 0s and 1s, packing each array into bytes as it arrives
+# Only one array and the bits left over from the previous one (under a byte) are held in memory
 @handle_errors
-def read_bits(file_path):
-    data = []
+def write_bit_chunks(file_path, chunks):
+    remainder = np.zeros(0, dtype=np.uint8)
+    with open(file_path, 'wb', buffering=WRITE_BUFFER_SIZE) as file:
+        for bits in chunks:
+            bits = np.concatenate((remainder, np.asarray(bits, dtype=np.uint8)))
+            whole = len(bits) - len(bits) % BYTE_BITS
+            file.write(np.packbits(bits[:whole]).tobytes())
+            remainder = bits[whole:]
+        if len(remainder):
+            file.write(np.packbits(remainder).tobytes())
+
+# Memory maps a file for reading, returns None for empty files
+def map_file(file_path):
     with open(file_path, 'rb') as file:
-        byte = file.read(1)
-        while byte:
-            for i in range(BYTE_BITS):
-                data.append((ord(byte) >> (7 - i) & 1))
-            byte = file.read(1)
-    return data
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
 
+# Writes bits to a file in one call, accepts a list of bits or a BitArray
 @handle_errors
 def write_bits(file_path, data):
+    if isinstance(data, BitArray):
+        byte_data = data.tobytes()
+    else:
+        byte_data = np.packbits(np.asarray(data, dtype=np.uint8)).tobytes()
     with open(file_path, 'wb') as file:
-        for i in range(0, len(data), BYTE_BITS):
-            byte = sum([int(data[j]) << (7 - j % BYTE_BITS) for j in range(i, min(i + BYTE_BITS, len(data)))])
-            file.write(bytes([byte]))
+        file.write(byte_data)
 
+# Reads a file as bytes, a size only reads the first size bytes
 @handle_errors
-def read_bytes(file_path, callback=None):
+def read_bytes(file_path, callback=None, size=None):
     with open(file_path, 'rb') as file:
         if callback:
             while True:
@@ -32,7 +139,7 @@ def read_bytes(file_path, callback=None):
                     break
                 callback(byte)
         else:
-            data = file.read()
+            data = file.read() if size is None else file.read(size)
     return data if not callback else None
 
 @handle_errors
@@ -44,6 +151,15 @@ def write_bytes(file_path, data=None):
         if data:
             file.write(data)
 
+# Appends data to the end of a file, creating the file if needed
+@handle_errors
+def append_bytes(file_path, data):
+    dir_name = os.path.dirname(file_path)
+    if not os.path.exists(dir_name):
+        os.makedirs(dir_name)
+    with open(file_path, 'ab') as file:
+        file.write(data)
+
 @handle_errors
 def read(file_path, callback=None):
     with open(file_path, 'r') as file:
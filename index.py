@@ -0,0 +1,335 @@
+import os
+import numpy as np
+from file_io import map_file
+from storage import pack_substruct_index, pack_value_index, unpack_log_substructs, unpack_log_values, unpack_remap_tables, unpack_substruct_index, unpack_value_index
+
+# Polynomial hash over struct values, modulo a Mersenne prime
+# The hash of concatenated values can be combined from the hashes and lengths of the parts,
+# so a parent struct is hashed from its substructs without expanding its values
+HASH_MOD = (1 << 61) - 1
+HASH_BASE = 0x5bd1e995
+
+# Hashes a list of values
+def hash_values(values):
+    value_hash = 0
+    for value in values:
+        value_hash = (value_hash * HASH_BASE + value + 1) % HASH_MOD
+    return value_hash
+
+# Combines (hash, length) parts, in order, into the (hash, length) of their concatenated values
+def combine_hashes(parts):
+    value_hash = 0
+    length = 0
+    for part_hash, part_length in parts:
+        value_hash = (value_hash * pow(HASH_BASE, part_length, HASH_MOD) + part_hash) % HASH_MOD
+        length += part_length
+    return value_hash, length
+
+# 64-bit hash of an ordered list of child IDs, used as the key of the substruct index
+# Keys wrap around modulo 2^64, so the same keys are computed with numpy for many structs at once
+KEY_BASE = 0x9e3779b97f4a7c15
+KEY_MASK = (1 << 64) - 1
+# Murmur3 finalizer constants, spread the bits of the polynomial over the whole key
+KEY_MIX_1 = 0xff51afd7ed558ccd
+KEY_MIX_2 = 0xc4ceb9fe1a85ec53
+
+# Hashes an ordered list of child IDs, (a, b), (b, a) and (a, a) all get different keys
+def hash_children(children):
+    key = len(children)
+    for child in children:
+        key = (key * KEY_BASE + child + 1) & KEY_MASK
+    key ^= key >> 33
+    key = (key * KEY_MIX_1) & KEY_MASK
+    key ^= key >> 33
+    key = (key * KEY_MIX_2) & KEY_MASK
+    return key ^ (key >> 33)
+
+# Hashes many lists of child IDs given back to back with the number of children in each list, all counts above 0
+def hash_children_arrays(children, counts):
+    counts = np.asarray(counts, dtype=np.int64)
+    powers = np.ones(int(counts.max(initial=0)) + 1, dtype=np.uint64)
+    powers[1:] = np.cumprod(np.full(len(powers) - 1, KEY_BASE, dtype=np.uint64))
+    # Each child is multiplied by the base once for every child after it in its list
+    offsets = np.cumsum(counts) - counts
+    remaining = np.repeat(offsets + counts - 1, counts) - np.arange(len(children))
+    terms = (np.asarray(children, dtype=np.uint64) + np.uint64(1)) * powers[remaining]
+    keys = counts.astype(np.uint64) * powers[counts]
+    if len(terms):
+        keys += np.add.reduceat(terms, offsets, dtype=np.uint64)
+    shift = np.uint64(33)
+    keys ^= keys >> shift
+    keys *= np.uint64(KEY_MIX_1)
+    keys ^= keys >> shift
+    keys *= np.uint64(KEY_MIX_2)
+    return keys ^ (keys >> shift)
+
+# Hashes (left, right) pairs of child IDs given as two arrays
+def hash_pairs(left, right):
+    children = np.empty(2 * len(left), dtype=np.uint64)
+    children[0::2] = left
+    children[1::2] = right
+    return hash_children_arrays(children, np.full(len(left), 2))
+
+# Maps value hashes to struct IDs and keeps the value hash and length of every struct
+# Stored entries are read in place from the index file, entries added since loading are kept in dicts
+class ValueIndex:
+    def __init__(self, sorted_hashes=None, sorted_ids=None, lengths=None, buffer=None):
+        empty = np.zeros(0, dtype=np.uint64)
+        self.sorted_hashes = empty if sorted_hashes is None else sorted_hashes
+        self.sorted_ids = empty if sorted_ids is None else sorted_ids
+        self.stored_lengths = empty if lengths is None else lengths
+        self.stored_hashes = None # Stored hashes by struct ID, placed on the first lookup by ID
+        self.stored_count = len(self.stored_lengths)
+        self.buffer = buffer
+
+        self.added = {} # (hash, length) by struct ID
+        self.buckets = {} # Struct IDs by hash
+        self.length_buckets = {} # Added struct IDs by length
+        self.length_order = None # Stored struct IDs ordered by length, sorted on the first length lookup
+        self.sorted_lengths = None # Stored lengths in the order of length_order
+        self.complete = True # Whether every struct in the database is indexed
+
+    # Loads the index file, returns an incomplete index if it is missing, has an older layout or does not match the database
+    def from_file(path, struct_count):
+        buffer = map_file(path) if os.path.exists(path) else None
+        arrays = unpack_value_index(buffer) if buffer else None
+        if arrays:
+            index = ValueIndex(*arrays, buffer=buffer)
+        else:
+            index = ValueIndex()
+        if index.stored_count != struct_count:
+            index = ValueIndex()
+            index.complete = struct_count == 0
+        return index
+
+    # Adds the entries saved in the value log after the index file was written
+    def load_log(self, path):
+        buffer = map_file(path) if os.path.exists(path) else None
+        if not buffer:
+            return
+        for id, value_hash, length in zip(*(array.tolist() for array in unpack_log_values(buffer))):
+            self.add(id, value_hash, length)
+        buffer.close()
+
+    # Number of struct IDs covered by the index
+    def size(self):
+        return max(self.stored_count, max(self.added, default=-1) + 1)
+
+    # Returns (hash, length) of a struct ID, or None if it is not indexed
+    def get(self, id):
+        entry = self.added.get(id)
+        if entry is None and id < self.stored_count:
+            entry = (int(self.get_stored_hashes()[id]), int(self.stored_lengths[id]))
+        return entry
+
+    # Returns the stored hashes by struct ID
+    def get_stored_hashes(self):
+        if self.stored_hashes is None:
+            self.stored_hashes = np.empty(self.stored_count, dtype=np.uint64)
+            self.stored_hashes[self.sorted_ids] = self.sorted_hashes
+        return self.stored_hashes
+
+    def add(self, id, value_hash, length):
+        self.added[id] = (value_hash, length)
+        self.buckets.setdefault(value_hash, []).append(id)
+        self.length_buckets.setdefault(length, []).append(id)
+
+    # Returns the IDs of all structs with the given value hash
+    def find(self, value_hash):
+        ids = []
+        if self.stored_count:
+            # Searched with a uint64 scalar, a Python int makes numpy convert the whole array
+            stored_hash = np.uint64(value_hash)
+            start = np.searchsorted(self.sorted_hashes, stored_hash, 'left')
+            end = np.searchsorted(self.sorted_hashes, stored_hash, 'right')
+            ids.extend(self.sorted_ids[start:end].tolist())
+        ids.extend(self.buckets.get(value_hash, []))
+        return ids
+
+    # Returns the IDs of all structs with the given value length, in ID order
+    def find_length(self, length):
+        ids = []
+        if self.stored_count:
+            if self.length_order is None:
+                self.length_order = np.argsort(self.stored_lengths, kind='stable')
+                self.sorted_lengths = self.stored_lengths[self.length_order].astype(np.uint64)
+            stored_length = np.uint64(length)
+            start = np.searchsorted(self.sorted_lengths, stored_length, 'left')
+            end = np.searchsorted(self.sorted_lengths, stored_length, 'right')
+            # Replaced structs are looked up in the added entries
+            ids.extend(id for id in self.length_order[start:end].tolist() if id not in self.added)
+        # Structs replaced with another length stay in the bucket of their old length
+        ids.extend(id for id in set(self.length_buckets.get(length, [])) if self.added[id][1] == length)
+        return sorted(ids)
+    
+    # Returns the hashes and lengths of every struct as arrays ordered by ID
+    def arrays(self):
+        count = self.size()
+        hashes = np.zeros(count, dtype=np.uint64)
+        lengths = np.zeros(count, dtype=np.uint64)
+        hashes[:self.stored_count] = self.get_stored_hashes()
+        lengths[:self.stored_count] = self.stored_lengths
+        for id, (value_hash, length) in self.added.items():
+            hashes[id] = value_hash
+            lengths[id] = length
+        return hashes, lengths
+
+    # Reorders the index after structs are renumbered, old_ids[new_id] is the previous ID of each struct
+    def remap(self, old_ids):
+        hashes, lengths = self.arrays()
+        old_ids = np.asarray(old_ids, dtype=np.int64)
+        self._set_stored(hashes[old_ids], lengths[old_ids])
+
+    # Moves every entry into memory and closes the index file
+    def detach(self):
+        self._set_stored(*self.arrays())
+
+    def _set_stored(self, hashes, lengths):
+        order = np.argsort(hashes, kind='stable')
+        self.stored_hashes = hashes
+        self.stored_lengths = lengths
+        self.sorted_hashes = hashes[order]
+        self.sorted_ids = order
+        self.stored_count = len(hashes)
+        self.added = {}
+        self.buckets = {}
+        self.length_buckets = {}
+        self.length_order = None
+        self.sorted_lengths = None
+        if self.buffer:
+            try:
+                self.buffer.close()
+            except BufferError:
+                # Still referenced elsewhere, closed once garbage collected
+                pass
+            self.buffer = None
+
+    def to_bytes(self):
+        return bytes(pack_value_index(*self.arrays()))
+
+# Maps struct IDs from before each compaction to the IDs after it
+# Blueprints keep the epoch (number of compactions) they were written in, so their IDs still resolve later
+# Each table only covers the IDs a compaction moved, from its first old ID on, every other ID is kept
+class IdRemap:
+    def __init__(self, tables=None, buffer=None):
+        self.tables = [] if tables is None else tables # (first old ID, new IDs) of each compaction
+        self.buffer = buffer
+
+    def from_file(path):
+        buffer = map_file(path) if os.path.exists(path) else None
+        if not buffer:
+            return IdRemap()
+        return IdRemap(unpack_remap_tables(buffer), buffer)
+
+    def epoch(self):
+        return len(self.tables)
+
+    # Number of struct IDs covered by the last compaction, the structs below it were renumbered before
+    def compacted_count(self):
+        if not self.tables:
+            return 0
+        first, new_ids = self.tables[-1]
+        return first + len(new_ids)
+
+    def add(self, new_ids, first=0):
+        self.tables.append((first, np.asarray(new_ids, dtype=np.uint32)))
+
+    # Returns the current ID of a struct ID written in the given epoch
+    def resolve(self, id, epoch):
+        if epoch > self.epoch():
+            raise ValueError("Blueprint is newer than the database.")
+        for first, new_ids in self.tables[epoch:]:
+            if id >= first + len(new_ids):
+                raise ValueError("Blueprint struct ID is out of range.")
+            if id >= first:
+                id = int(new_ids[id - first])
+        return id
+
+# Maps the ordered child IDs of structs to struct IDs (hash-consing), so a struct is only added once
+# Stored keys are read in place from the index file, keys added since loading are kept in a dict
+# Keys are hashes, so the children of the structs found are checked by the caller
+class SubstructIndex:
+    def __init__(self, sorted_keys=None, sorted_ids=None, struct_count=0, buffer=None):
+        self.sorted_keys = np.zeros(0, dtype=np.uint64) if sorted_keys is None else sorted_keys
+        self.sorted_ids = np.zeros(0, dtype=np.uint32) if sorted_ids is None else sorted_ids
+        self.struct_count = struct_count # Number of structs in the database the stored keys were written for
+        self.buffer = buffer
+
+        self.buckets = {} # Struct IDs by key
+        self.complete = True # Whether every struct in the database is indexed
+
+    # Loads the index file, returns an incomplete index if it is missing or does not match the database
+    def from_file(path, struct_count):
+        buffer = map_file(path) if os.path.exists(path) else None
+        if buffer:
+            stored_count, sorted_keys, sorted_ids = unpack_substruct_index(buffer)
+            index = SubstructIndex(sorted_keys, sorted_ids, stored_count, buffer)
+        else:
+            index = SubstructIndex()
+        if index.struct_count != struct_count:
+            index = SubstructIndex()
+            index.complete = struct_count == 0
+        return index
+
+    # Indexes every struct of a struct store, every struct is loaded
+    def from_store(store):
+        ids, keys = child_keys(store, np.arange(len(store)))
+        order = np.argsort(keys, kind='stable')
+        return SubstructIndex(keys[order], ids[order].astype(np.uint32), len(store))
+
+    # Adds the keys saved in the substruct log after the index file was written
+    def load_log(self, path):
+        buffer = map_file(path) if os.path.exists(path) else None
+        if not buffer:
+            return
+        for id, key in zip(*(array.tolist() for array in unpack_log_substructs(buffer))):
+            self.add(id, key)
+        buffer.close()
+
+    def add(self, id, key):
+        self.buckets.setdefault(key, []).append(id)
+
+    # Returns the IDs of all structs with the given key, stored structs first
+    def find(self, key):
+        ids = []
+        if len(self.sorted_keys):
+            # Searched with a uint64 scalar, a Python int makes numpy convert the whole array
+            stored_key = np.uint64(key)
+            start = np.searchsorted(self.sorted_keys, stored_key, 'left')
+            end = np.searchsorted(self.sorted_keys, stored_key, 'right')
+            ids.extend(self.sorted_ids[start:end].tolist())
+        ids.extend(self.buckets.get(key, []))
+        return ids
+
+    # Returns the lowest stored struct ID with each key, -1 where no stored struct has the key
+    def find_stored(self, keys):
+        ids = np.full(len(keys), -1, dtype=np.int64)
+        if len(self.sorted_keys):
+            positions = np.searchsorted(self.sorted_keys, keys).clip(max=len(self.sorted_keys) - 1)
+            found = self.sorted_keys[positions] == keys
+            ids[found] = self.sorted_ids[positions[found]]
+        return ids
+
+    # Returns whether each key has structs added since loading
+    def has_added(self, keys):
+        return np.fromiter((key in self.buckets for key in keys.tolist()), dtype=bool, count=len(keys))
+
+    # Closes the index file, the index is not used afterwards
+    def release(self):
+        if self.buffer:
+            try:
+                self.buffer.close()
+            except BufferError:
+                # Still referenced elsewhere, closed once garbage collected
+                pass
+            self.buffer = None
+
+    # Only stored keys are written, indexes with added keys are rebuilt with from_store first
+    def to_bytes(self):
+        return bytes(pack_substruct_index(self.struct_count, self.sorted_keys, self.sorted_ids))
+
+# Returns (IDs, keys) of the given structs which have children, the structs are loaded
+def child_keys(store, ids):
+    children, counts = store.gather_children(ids)
+    has_children = counts > 0
+    return ids[has_children], hash_children_arrays(children, counts[has_children])
@@ -1,11 +1,56 @@
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import queue
+import threading
 import time
 from error_handler import handle_errors
-from file_io import read_bits, read_bytes, write_bits, write_bytes
+from file_io import BitArray, read_bit_windows, read_bits, read_bytes, write_bit_chunks, write_bytes
 import os
-import sys
 from settings import Settings
-from catalog import Catalog
-from database import DBCMD, Database
+from catalog import SEGMENT_SIZE, Catalog, convert_file, init_convert_worker
+from database import DATABASE_EXTENSIONS, DBCMD, Database
+from manifest import MANIFEST_FILE, Manifest
+from metrics import METRICS_FILES, metrics, write_metrics
+from storage import SDB_VERSION
+from watcher import SCAN_INDEX_FILE, ScanIndex, Watcher, scan_files
+
+# Files which are never catalogued from a directory
+SKIPPED_EXTENSIONS = ('.sbp',) + DATABASE_EXTENSIONS
+# Seconds a pipeline stage waits on a queue before checking whether the pipeline was stopped
+QUEUE_POLL_INTERVAL = 0.1
+# Files converted ahead of the catalog by process_files, per worker process
+CONVERT_AHEAD = 2
+
+# Puts an item on a bounded queue, waiting while it is full unless the pipeline is stopped
+def put_until(items, item, stop):
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=QUEUE_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+# Gets an item from a queue, returns None once the pipeline is stopped and the queue is empty
+def get_until(items, stop):
+    while True:
+        try:
+            return items.get(timeout=QUEUE_POLL_INTERVAL)
+        except queue.Empty:
+            if stop.is_set():
+                return None
+
+# Yields func of each item in order like executor.map, with at most limit items submitted and not yet yielded,
+# so the results waiting in memory are bounded by the limit rather than the number of items
+def bounded_map(executor, func, items, limit):
+    pending = deque()
+    for item in items:
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
 
 # Order of operations in production:
 # 1. Manager checks for new data or user inputs a file
@@ -18,31 +63,83 @@ from database import DBCMD, Database
 
 class Manager:
     def __init__(self):
-        if len(sys.argv) > 1:
-            self.settings = Settings()
+        args = self.parse_args()
+        self.settings = Settings()
+        # With auto catalog on, running without a path watches the data directory
+        watch = args.watch or (self.settings.auto_catalog and not (args.path or args.migrate or args.compact))
+        if args.path or args.migrate or args.compact or watch:
             data_dir = os.path.join(os.getcwd(), self.settings.data_directory)
-            self.database = Database(data_dir)
-            self.catalog = Catalog(self.database, self.settings.auto_catalog)
+            self.database = Database(data_dir, self.settings)
+            self.catalog = Catalog(self.database, self.settings.auto_catalog, self.settings.segment_cache_size,
+                                   self.settings.cache_admission, self.settings.symbol_width)
+            # Blueprints of the files catalogued before, files with the same content are not catalogued again
+            self.manifest = Manifest.from_file(os.path.join(data_dir, MANIFEST_FILE))
+            
+            if args.migrate:
+                self.database.query(DBCMD.MIGRATE_DB, args.migrate)
+                return
+            
+            if args.compact:
+                self.database.query(DBCMD.COMPACT_DB)
+                return
+            
+            if watch:
+                self.watch(args.path or data_dir, data_dir, args.jobs or 1, args.once)
+                return
             
             # Relative to working directory
-            input_path = sys.argv[1]
-            if os.path.isdir(input_path):
+            input_path = args.path
+            if os.path.isdir(input_path) and args.pipeline:
+                self.process_tree(input_path, data_dir)
+            elif os.path.isdir(input_path):
                 folder_path = input_path
+                file_paths = []
                 for filename in os.listdir(folder_path):
                     file_path = os.path.join(folder_path, filename)
                     if os.path.isfile(file_path):
                         # Skip database and blueprint files
-                        if file_path.lower().endswith(('.sbp', '.sdb', '.sdbp')):
+                        if file_path.lower().endswith(SKIPPED_EXTENSIONS):
                             continue
+                        file_paths.append(file_path)
+                
+                if args.jobs:
+                    self.process_files(file_paths, data_dir, args.jobs)
+                else:
+                    for file_path in file_paths:
                         self.process_file(file_path, data_dir)
+                self.manifest.save()
             elif os.path.isfile(input_path):
                 self.process_file(input_path, data_dir)
+                self.manifest.save()
                 return
             else:
                 raise ValueError("Provided path is neither a directory nor a file")
         else:
             raise ValueError("No input path provided")
+    
+    def parse_args(self):
+        """
+        Parses the command line arguments.
         
+        Returns:
+            argparse.Namespace: The input path and options.
+        """
+        parser = argparse.ArgumentParser(description="Catalog files into the N-STRUCT database.")
+        parser.add_argument("path", nargs="?", help="File or directory to catalog, or a blueprint to restore")
+        parser.add_argument("--migrate", type=int, nargs="?", const=SDB_VERSION, metavar="VERSION",
+                            help=f"Rewrite the database in the given SDB format version (default: {SDB_VERSION}) and exit")
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument("--jobs", type=int, metavar="N",
+                          help="Catalog a directory as one batch, reading and converting files in N worker processes (same database as without --jobs)")
+        mode.add_argument("--pipeline", action="store_true",
+                          help="Catalog a directory and its subdirectories, reading files ahead and writing blueprints in background threads")
+        parser.add_argument("--compact", action="store_true",
+                            help="Fold the append-only log into the database files, renumbering the structs added since the last compaction, and exit")
+        parser.add_argument("--watch", action="store_true",
+                            help="Keep cataloguing new and changed files in the directory (default: the data directory) until interrupted")
+        parser.add_argument("--once", action="store_true",
+                            help="With --watch, catalog the files changed since the last scan and exit")
+        return parser.parse_args()
     
     def process_file(self, file_path, data_dir):
         """
@@ -58,11 +155,14 @@ class Manager:
         Prints:
             - If the file is not found or unreadable, it prints a message with the file path.
             - If the file is a blueprint, it saves the raw blueprint data to the specified directory and prints a message with the file path.
+            - If a file with the same content was catalogued before, its blueprint is saved again without cataloging the file.
             - If the file is not a blueprint, it generates a blueprint using the catalog, prints the duration of the cataloging process, and saves it to the specified directory.
+            - Files larger than the stream window size setting are read and catalogued one window at a time.
             - If the blueprint generation fails, it prints a failure message.
         """
         start_time = time.time()
-        file_data = read_bytes(file_path)
+        # Only the header is read up front, large files are never read whole
+        file_data = read_bytes(file_path, size=3)
         file_name = os.path.basename(file_path) + ".sbp"
         
         if not file_data:
@@ -71,15 +171,28 @@ class Manager:
         
         if self.is_blueprint(file_data):
             # TODO: If blueprint does not already exist in the database, add it
-            file_data = self.database.query(DBCMD.GET_BLUEPRINT_BYTES, file_data)
-            bp_raw_path = os.path.join(data_dir, file_name)
-            write_bits(bp_raw_path, file_data)
+            with metrics.timer('restore'):
+                struct = self.database.query(DBCMD.GET_BLUEPRINT_STRUCT, read_bytes(file_path))
+                bp_raw_path = os.path.join(data_dir, file_name)
+                # The data is streamed to the file as the struct tree is walked
+                write_bit_chunks(bp_raw_path, struct.iter_value_chunks())
             print(f"Saved raw blueprint data to: {bp_raw_path}")
+            self.write_metrics(data_dir, file=file_path)
+            return
+        
+        digest = self.file_digest(file_path)
+        if self.reuse_blueprint(file_path, digest, data_dir):
             return
         
-        file_data = read_bits(file_path)
-        print(f"Cataloguing file {file_path}...")
-        blueprint = self.catalog.try_catalog(file_data)
+        window_size = self.settings.stream_window_size
+        if window_size and os.path.getsize(file_path) > window_size:
+            print(f"Cataloguing file {file_path} in windows of {window_size} bytes...")
+            blueprint = self.catalog.try_catalog_windows(metrics.timed_iter('read', read_bit_windows(file_path, window_size)))
+        else:
+            with metrics.timer('read'):
+                file_data = read_bits(file_path, packed=True)
+            print(f"Cataloguing file {file_path}...")
+            blueprint = self.catalog.try_catalog(file_data)
         
         if not blueprint:
             print("Failed to generate blueprint!")
@@ -88,11 +201,310 @@ class Manager:
         end_time = time.time() # Record the end time
         cataloging_duration = end_time - start_time # Calculate the duration
         
-        print(f"Catalogued file {file_path} in: {int(cataloging_duration)} seconds.")
+        print(f"Catalogued file {file_path} in: {cataloging_duration:.2f} seconds.")
         
         # Save blueprint to file
         write_bytes(os.path.join(data_dir, file_name), blueprint)
+        self.record_blueprint(file_path, digest, blueprint)
         print(f"Saved blueprint to: {os.path.join(data_dir, file_name)}")
+        self.write_metrics(data_dir, file=file_path)
+
+    def process_files(self, file_paths, data_dir, jobs):
+        """
+        Catalog files as one batch. Worker processes read the files and convert their bits to substruct IDs,
+        while this process owns the database, adds the structs of each file and saves the database once at the end.
+        
+        Args:
+            file_paths (list): The paths of the files to be catalogued, in order.
+            data_dir (str): The directory where the blueprints will be saved.
+            jobs (int): The number of worker processes, 1 converts files in this process.
+        
+        Notes:
+            - Files are converted against the lowest structs, which adding structs does not change, and structs are added
+              in file order, files larger than stream_window_size one window at a time like process_file does.
+              So the resulting database is the same as cataloguing the files one at a time, for any number of jobs.
+            - Blueprints are written after the database is saved, with the epoch from before the save.
+            - Files with the same content as a file catalogued before reuse its blueprint and are left out of the batch.
+            - Blueprint files in the batch are restored like process_file does, not catalogued as data.
+            - At most CONVERT_AHEAD files per job are converted ahead of the catalog, so memory is bounded by jobs.
+        """
+        start_time = time.time()
+        is_blueprints = [self.is_blueprint(read_bytes(file_path, size=3) or b"") for file_path in file_paths]
+        for file_path in [file_path for file_path, is_blueprint in zip(file_paths, is_blueprints) if is_blueprint]:
+            self.process_file(file_path, data_dir)
+        file_paths = [file_path for file_path, is_blueprint in zip(file_paths, is_blueprints) if not is_blueprint]
+        digests = {file_path: self.file_digest(file_path) for file_path in file_paths}
+        file_paths = [file_path for file_path in file_paths if not self.reuse_blueprint(file_path, digests[file_path], data_dir)]
+        if not file_paths:
+            return
+        self.catalog.ensure_structs()
+        symbols = self.catalog.get_symbol_table()
+        matcher = None if symbols else self.catalog.get_matcher()
+        
+        executor = None
+        worker_args = (matcher, SEGMENT_SIZE, symbols, self.settings.stream_window_size)
+        if jobs > 1:
+            executor = ProcessPoolExecutor(jobs, initializer=init_convert_worker, initargs=worker_args)
+            results = bounded_map(executor, convert_file, file_paths, CONVERT_AHEAD * jobs)
+        else:
+            init_convert_worker(*worker_args)
+            results = map(convert_file, file_paths)
+        
+        catalogued = []
+        try:
+            # Files are read and converted by the workers, waiting for them is timed as conversion
+            for file_path, substruct_ids in zip(file_paths, metrics.timed_iter('convert', results)):
+                if substruct_ids is None or len(substruct_ids) == 0:
+                    print(f"File not found or unreadable: {file_path}")
+                    continue
+                print(f"Cataloguing file {file_path}...")
+                if isinstance(substruct_ids, list):
+                    # Windows of a large file, the symbols of each window are looked up once the windows before it are catalogued
+                    id_windows = (self.catalog.symbol_ids(ids) if symbols else ids for ids in substruct_ids)
+                    catalogued.append((file_path, self.catalog.catalog_id_windows(id_windows)))
+                    continue
+                if symbols:
+                    substruct_ids = self.catalog.symbol_ids(substruct_ids)
+                catalogued.append((file_path, self.catalog.catalog_ids(substruct_ids)))
+        finally:
+            if executor:
+                executor.shutdown()
+        
+        # Blueprints record the epoch, so their IDs still resolve after later compactions
+        epoch = self.database.query(DBCMD.GET_EPOCH)
+        self.database.query(DBCMD.SAVE_DB)
+        
+        for file_path, struct in catalogued:
+            blueprint_path = os.path.join(data_dir, os.path.basename(file_path) + ".sbp")
+            blueprint = struct.to_blueprint(epoch=epoch)
+            write_bytes(blueprint_path, blueprint)
+            self.record_blueprint(file_path, digests[file_path], blueprint)
+            metrics.count('bytes_in', os.path.getsize(file_path))
+            metrics.count('blueprint_bytes_out', len(blueprint))
+            print(f"Saved blueprint to: {blueprint_path}")
+        
+        print(f"Catalogued {len(catalogued)} files in: {time.time() - start_time:.2f} seconds.")
+        self.write_metrics(data_dir, files=len(catalogued))
+    
+    def watch(self, watch_dir, data_dir, jobs=1, once=False):
+        """
+        Watch a directory and catalog new and changed files in batches, keeping the database in memory between batches.
+        
+        Args:
+            watch_dir (str): The directory to watch.
+            data_dir (str): The directory where the blueprints and the scan index will be saved.
+            jobs (int, optional): The number of worker processes each batch is converted in. Defaults to 1.
+            once (bool, optional): Catalog the files changed since the last scan and return instead of watching. Defaults to False.
+        
+        Notes:
+            - The scan index in the data directory records the size, mtime and inode each file had when it was catalogued,
+              so a restarted watcher only catalogs the files changed since.
+            - Files modified within the watch_debounce setting (seconds) are left for a later scan, they may still be written.
+            - Database files, blueprints, metrics, the manifest and the scan index are never catalogued.
+        """
+        watch_dir = os.path.abspath(watch_dir)
+        if not os.path.isdir(watch_dir):
+            raise ValueError("Provided watch path is not a directory")
+        
+        watcher = Watcher(
+            watch_dir,
+            ScanIndex.from_file(os.path.join(data_dir, SCAN_INDEX_FILE)),
+            self.settings.watch_debounce,
+            self.settings.watch_batch_size,
+            SKIPPED_EXTENSIONS,
+            self.data_file_paths(data_dir))
+        
+        def process_batch(file_paths):
+            self.process_files(file_paths, data_dir, jobs)
+            self.manifest.save()
+        
+        print(f"Watching {watch_dir} for new files...")
+        try:
+            watcher.run(process_batch, self.settings.watch_interval, once)
+        except KeyboardInterrupt:
+            print(f"Stopped watching {watch_dir}")
+    
+    def process_tree(self, root, data_dir):
+        """
+        Catalog a directory and its subdirectories as a pipeline of three stages connected by bounded queues,
+        so reading files and writing blueprints overlap with cataloging.
+        
+        Args:
+            root (str): The directory to be catalogued.
+            data_dir (str): The directory where the blueprints will be saved, under the path of each file relative to root.
+        
+        Notes:
+            - A reader thread reads the next files into memory, files larger than the stream window size one window at a time.
+              At most pipeline_depth files or windows wait in memory, the reader blocks until the catalog takes the next one.
+            - This thread catalogs the files in order and saves the database every pipeline_save_interval files.
+              Cataloging waits for each save while the reader keeps reading ahead.
+            - A writer thread writes the blueprints of each saved batch, a blueprint is only written once its structs are saved.
+            - Files with the same content as a file catalogued before reuse its blueprint, see reuse_blueprint.
+            - The stages share the manifest and metrics, which lock their updates.
+        """
+        start_time = time.time()
+        root = os.path.abspath(root)
+        data_dir = os.path.abspath(data_dir)
+        # The data directory is skipped when it is inside the catalogued directory
+        file_paths = [file_path for file_path, _ in scan_files(root, SKIPPED_EXTENSIONS, set([data_dir] + self.data_file_paths(data_dir)), recursive=True)]
+        self.catalog.ensure_structs()
+        
+        read_queue = queue.Queue(self.settings.pipeline_depth)
+        write_queue = queue.Queue(self.settings.pipeline_depth)
+        stop = threading.Event()
+        try:
+            with ThreadPoolExecutor(2, thread_name_prefix="pipeline") as executor:
+                reader = executor.submit(self.read_stage, file_paths, root, data_dir, read_queue, stop)
+                writer = executor.submit(self.write_stage, root, data_dir, write_queue, stop)
+                try:
+                    catalogued = self.catalog_stage(read_queue, write_queue, stop)
+                    reader.result()
+                finally:
+                    # The writer finishes the batches already queued
+                    stop.set()
+                writer.result()
+        finally:
+            # Only the blueprints of saved batches are in the manifest
+            self.manifest.save()
+        
+        print(f"Catalogued {catalogued} files in: {time.time() - start_time:.2f} seconds.")
+        self.write_metrics(data_dir, files=catalogued)
+    
+    # Reader stage of process_tree, puts ('file', path, bits, digest) for each file or ('window', path, bits, digest) for each window
+    # of a large file followed by ('end', path, None, digest) on the read queue, then ('done', None, None, None)
+    # The digest of each file is taken before it is read
+    def read_stage(self, file_paths, root, data_dir, read_queue, stop):
+        window_size = self.settings.stream_window_size
+        try:
+            for file_path in file_paths:
+                if stop.is_set():
+                    return
+                digest = self.file_digest(file_path)
+                if self.reuse_blueprint(file_path, digest, data_dir, root):
+                    continue
+                if window_size and os.path.getsize(file_path) > window_size:
+                    for window in metrics.timed_iter('read', read_bit_windows(file_path, window_size)):
+                        put_until(read_queue, ('window', file_path, window, digest), stop)
+                    put_until(read_queue, ('end', file_path, None, digest), stop)
+                    continue
+                with metrics.timer('read'):
+                    file_data = read_bytes(file_path)
+                if not file_data:
+                    print(f"File not found or unreadable: {file_path}")
+                    continue
+                put_until(read_queue, ('file', file_path, BitArray(file_data), digest), stop)
+            put_until(read_queue, ('done', None, None, None), stop)
+        except BaseException:
+            stop.set()
+            raise
+    
+    # Catalog stage of process_tree, catalogs the files from the read queue and puts each saved batch of
+    # (path, digest, blueprint) on the write queue, returns the number of catalogued files
+    def catalog_stage(self, read_queue, write_queue, stop):
+        catalogued = 0
+        batch = []
+        while True:
+            item = get_until(read_queue, stop)
+            if item is None:
+                return catalogued
+            kind, file_path, data, digest = item
+            if kind == 'done':
+                break
+            
+            print(f"Cataloguing file {file_path}...")
+            if kind == 'file':
+                metrics.count('bytes_in', (len(data) + 7) // 8)
+                struct = self.catalog.catalog_ids(self.catalog.convert_to_ids(data))
+            else:
+                struct = self.catalog.catalog_windows(self.queued_windows(data, read_queue, stop))
+            if stop.is_set():
+                # The windows of the file may have been cut short
+                return catalogued
+            if struct is None:
+                print("Failed to generate blueprint!")
+                continue
+            # The blueprint records the epoch, so its IDs still resolve after later compactions
+            batch.append((file_path, digest, struct.to_blueprint(epoch=self.database.query(DBCMD.GET_EPOCH))))
+            catalogued += 1
+            if len(batch) >= self.settings.pipeline_save_interval:
+                self.database.query(DBCMD.SAVE_DB)
+                put_until(write_queue, batch, stop)
+                batch = []
+        
+        if batch:
+            self.database.query(DBCMD.SAVE_DB)
+            put_until(write_queue, batch, stop)
+        return catalogued
+    
+    # Yields the first window of a large file and the rest of its windows from the read queue
+    def queued_windows(self, window, read_queue, stop):
+        yield window
+        while (item := get_until(read_queue, stop)) is not None and item[0] == 'window':
+            yield item[2]
+    
+    # Writer stage of process_tree, writes the blueprints of each batch from the write queue
+    def write_stage(self, root, data_dir, write_queue, stop):
+        try:
+            while (batch := get_until(write_queue, stop)) is not None:
+                for file_path, digest, blueprint in batch:
+                    blueprint_path = self.blueprint_path(file_path, data_dir, root)
+                    write_bytes(blueprint_path, blueprint)
+                    self.record_blueprint(file_path, digest, blueprint)
+                    metrics.count('blueprint_bytes_out', len(blueprint))
+                    print(f"Saved blueprint to: {blueprint_path}")
+        except BaseException:
+            stop.set()
+            raise
+    
+    # Returns the path of the blueprint of a file, files under a root directory keep their path relative to it
+    def blueprint_path(self, file_path, data_dir, root=None):
+        name = os.path.relpath(file_path, root) if root else os.path.basename(file_path)
+        return os.path.join(data_dir, name + ".sbp")
+    
+    # Returns the paths of the files this tool keeps in the data directory, besides the database files and blueprints
+    def data_file_paths(self, data_dir):
+        names = [SCAN_INDEX_FILE, MANIFEST_FILE] + list(METRICS_FILES.values())
+        if self.settings.metrics_file:
+            names.append(self.settings.metrics_file)
+        paths = [os.path.join(data_dir, name) for name in names]
+        # Files being written are saved next to their path first
+        return paths + [path + ".tmp" for path in paths]
+    
+    # Returns the content digest of a file, None if it cannot be read
+    # Taken before the file is read, so its blueprint is only recorded for the content it was made from, see record_blueprint
+    # Only the size and mtime of a file are checked when they did not change since its digest was taken
+    def file_digest(self, file_path):
+        try:
+            return self.manifest.digest(file_path)
+        except OSError:
+            return None
+    
+    # Records the blueprint of a catalogued file in the manifest, unless the file changed since its digest was taken
+    def record_blueprint(self, file_path, digest, blueprint):
+        if not self.manifest.add(file_path, digest, blueprint):
+            print(f"File changed while cataloguing, it is catalogued again next time: {file_path}")
+    
+    # Saves the blueprint of a file with the same content catalogued before, returns whether there was one
+    def reuse_blueprint(self, file_path, digest, data_dir, root=None):
+        if digest is None:
+            return False
+        blueprint = self.manifest.get(digest)
+        if blueprint is None:
+            return False
+        
+        blueprint_path = self.blueprint_path(file_path, data_dir, root)
+        if not os.path.exists(blueprint_path) or read_bytes(blueprint_path) != blueprint:
+            write_bytes(blueprint_path, blueprint)
+        metrics.count('files_skipped')
+        print(f"Skipped unchanged file {file_path}, blueprint: {blueprint_path}")
+        return True
+    
+    # Writes the metrics of this process, if metrics output is turned on in the settings
+    def write_metrics(self, data_dir, **labels):
+        format = self.settings.metrics_format
+        if format:
+            metrics_path = os.path.join(data_dir, self.settings.metrics_file or METRICS_FILES[format])
+            write_metrics(metrics_path, format, **labels)
 
     def is_blueprint(self, bytes):
         """
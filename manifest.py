@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import threading
+
+# File in the data directory the ingest manifest is kept in
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+# Bytes of a file hashed at a time
+DIGEST_CHUNK_SIZE = 1 << 20
+
+# Returns the content digest of a file, blake2b over its bytes
+def file_digest(file_path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        while chunk := file.read(DIGEST_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Blueprints of the files catalogued before, by content digest, kept in a JSON file next to the database
+# Files are only hashed when their size or mtime differ from when their digest was last taken
+# Blueprints store the epoch they were made in, so they stay valid across compactions of the database
+# Lookups and updates take a lock, the reader and writer threads of the pipelined directory mode share the manifest
+class Manifest:
+    def __init__(self, path=None, files=None, blueprints=None):
+        self.path = path
+        self.files = files or {} # (size, mtime in ns, digest) by file path
+        self.blueprints = blueprints or {} # Blueprint bytes by digest
+        self.changed = False
+        self.lock = threading.Lock()
+
+    # Loads the manifest, a missing or unreadable file gives an empty manifest
+    def from_file(path):
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return Manifest(path)
+        if data.get('version') != MANIFEST_VERSION:
+            return Manifest(path)
+        return Manifest(
+            path,
+            {file_path: tuple(entry) for file_path, entry in data['files'].items()},
+            {digest: bytes.fromhex(blueprint) for digest, blueprint in data['blueprints'].items()})
+
+    # Returns the content digest of a file, reusing the digest taken last time if its size and mtime are the same
+    def digest(self, file_path):
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        with self.lock:
+            entry = self.files.get(file_path)
+        if entry and entry[:2] == (stat.st_size, stat.st_mtime_ns):
+            return entry[2]
+        # Hashed outside the lock, so a large file does not hold up the other thread
+        digest = file_digest(file_path)
+        with self.lock:
+            self.files[file_path] = (stat.st_size, stat.st_mtime_ns, digest)
+            self.changed = True
+        return digest
+
+    # Returns the blueprint of the content with a digest, or None if no file with the same content was catalogued
+    def get(self, digest):
+        with self.lock:
+            return self.blueprints.get(digest)
+
+    # Records the blueprint of a catalogued file under the digest taken before the file was read, returns whether it was recorded
+    # Nothing is recorded if the file changed or is gone since, the blueprint is not of its current content
+    def add(self, file_path, digest, blueprint):
+        try:
+            if digest is None or self.digest(file_path) != digest:
+                return False
+        except OSError:
+            return False
+        with self.lock:
+            self.blueprints[digest] = bytes(blueprint)
+            self.changed = True
+        return True
+
+    # Writes the manifest if it changed, next to its path first so an interrupted save keeps the previous manifest
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w') as file:
+                json.dump({
+                    'version': MANIFEST_VERSION,
+                    'files': self.files,
+                    'blueprints': {digest: blueprint.hex() for digest, blueprint in self.blueprints.items()},
+                }, file)
+            os.replace(temp_path, self.path)
+            self.changed = False
@@ -0,0 +1,121 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+# Prefix of the metric names written in the Prometheus text format
+PROMETHEUS_PREFIX = "nstruct"
+# Metrics output formats, see write_metrics
+METRICS_FORMATS = ("json", "prometheus")
+# File the metrics are written to in each format when no file is set
+METRICS_FILES = {"json": "metrics.jsonl", "prometheus": "metrics.prom"}
+
+# A count kept by its owner on a hot path (such as a cache lookup) without taking the metrics lock,
+# added to the counters of the metrics when they are read. Only updated from one thread
+class Counter:
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+# Per-stage timers and counters of the catalog pipeline, kept for the life of the process
+# Updates take a lock, the stages of the pipelined directory mode count from several threads
+class Metrics:
+    def __init__(self):
+        self.timers = {} # [runs, total seconds] by stage
+        self.counters = {} # Count by name
+        self.hot_counters = [] # Counters kept by their owners, see counter
+        self.lock = threading.Lock()
+
+    # Returns a new counter added in under its name when the metrics are read
+    # Counters outlive their owners, so counts of dropped caches are kept
+    def counter(self, name):
+        counter = Counter(name)
+        with self.lock:
+            self.hot_counters.append(counter)
+        return counter
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Adds the time spent in the with block to a stage
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(stage, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    # Yields the items of an iterable, the time spent producing them is added to a stage
+    def timed_iter(self, stage, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            for counter in self.hot_counters:
+                counters[counter.name] = counters.get(counter.name, 0) + counter.value
+            return {
+                'timers': {stage: {'runs': runs, 'seconds': seconds} for stage, (runs, seconds) in self.timers.items()},
+                'counters': counters,
+            }
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+            for counter in self.hot_counters:
+                counter.value = 0
+
+    # Returns the metrics as one JSON line, with the given labels
+    def to_json_line(self, **labels):
+        return json.dumps({'time': time.time(), **labels, **self.snapshot()}) + "\n"
+
+    # Returns the metrics in the Prometheus text exposition format
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        timers = snapshot['timers']
+        lines = []
+        for name, kind, samples in (
+            ("stage_runs_total", "counter", [(f'{{stage="{stage}"}}', timer['runs']) for stage, timer in timers.items()]),
+            ("stage_seconds_total", "counter", [(f'{{stage="{stage}"}}', timer['seconds']) for stage, timer in timers.items()])):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+            lines.extend(f"{PROMETHEUS_PREFIX}_{name}{labels} {value}" for labels, value in samples)
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name}_total counter")
+            lines.append(f"{PROMETHEUS_PREFIX}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+# Metrics of this process, shared by the catalog, database and manager
+metrics = Metrics()
+
+# Writes the metrics to a file, JSON lines are appended and the Prometheus file is replaced
+# The Prometheus file is written next to its path first, so a collector reading it never sees a partial file
+def write_metrics(path, format, **labels):
+    if format == "json":
+        with open(path, 'a') as file:
+            file.write(metrics.to_json_line(**labels))
+    elif format == "prometheus":
+        temp_path = path + ".tmp"
+        with open(temp_path, 'w') as file:
+            file.write(metrics.to_prometheus())
+        os.replace(temp_path, path)
+    else:
+        raise ValueError(f"Unknown metrics format: {format}")
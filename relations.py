@@ -0,0 +1,177 @@
+import numpy as np
+from store import ranges
+
+# Number of nearest structs in context each struct keeps distances and count differences to
+NEAREST_COUNT = 16
+# Number of positions the nearest relations are computed for at a time by iter_nearest
+NEAREST_BLOCK_SIZE = 1 << 16
+
+# Relations of every struct in a context, computed for all positions at once
+# The context is a key of appearance for each struct (struct IDs) in order of appearance, the position of a struct is its index
+# Frequencies come from one grouping pass over the keys, distances and count differences are (positions, k) arrays
+# over the k nearest positions computed for a block of positions at a time, so memory stays bounded however long the context is
+class ContextRelations:
+    def __init__(self, keys, k=NEAREST_COUNT):
+        keys = np.asarray(keys)
+        self.k = min(k, max(len(keys) - 1, 0))
+
+        # Structs with the same key share a group
+        _, groups, group_counts = np.unique(keys, return_inverse=True, return_counts=True)
+        self.groups = groups.reshape(-1).astype(np.int32)
+        self.group_counts = group_counts.astype(np.int32)
+        self.counts = self.group_counts[self.groups] # How often the struct at each position appears in context
+        # Positions of the previous and next struct with the same key, -1 where there is none
+        self.previous_same, self.next_same = self._same_neighbours()
+
+    # Makes the relations of a list of structs, structs without an ID are told apart by their values
+    def from_structs(structs, k=NEAREST_COUNT):
+        groups = {}
+        keys = [groups.setdefault(struct.id if struct.id is not None else tuple(struct.values), len(groups)) for struct in structs]
+        return ContextRelations(np.array(keys, dtype=np.int64), k)
+
+    def __len__(self):
+        return len(self.counts)
+
+    # Returns (positions, distances, count differences) of the k nearest structs of each position from start to end,
+    # each an (end - start, k) array in order of position
+    def nearest(self, start=0, end=None):
+        end = len(self) if end is None else end
+        positions = np.arange(start, end, dtype=np.int32)
+        neighbours = self._nearest(positions)
+        return neighbours, np.abs(neighbours - positions[:, None]), self.counts[neighbours] - self.counts[start:end, None]
+
+    # Yields (start, positions, distances, count differences) of the k nearest structs for one block of positions at a time
+    def iter_nearest(self, block_size=NEAREST_BLOCK_SIZE):
+        for start in range(0, len(self), block_size):
+            yield start, *self.nearest(start, min(start + block_size, len(self)))
+
+    # A window of k + 1 positions around each position holds the position itself and its k nearest,
+    # windows are shifted inwards at the ends of the context, ties go to the left
+    def _nearest(self, positions):
+        k = self.k
+        starts = np.clip(positions - (k + 1) // 2, 0, max(len(self) - k - 1, 0))
+        window = starts[:, None] + np.arange(k + 1, dtype=np.int32)
+        return window[window != positions[:, None]].reshape(len(positions), k)
+
+    def _same_neighbours(self):
+        order = np.argsort(self.groups, kind='stable')
+        same = self.groups[order[1:]] == self.groups[order[:-1]]
+        previous_same = np.full(len(self.groups), -1, dtype=np.int32)
+        next_same = np.full(len(self.groups), -1, dtype=np.int32)
+        previous_same[order[1:][same]] = order[:-1][same]
+        next_same[order[:-1][same]] = order[1:][same]
+        return previous_same, next_same
+
+
+# Number of features describing the relations of a struct, see relation_features
+FEATURE_COUNT = 7
+
+# Returns the relation features of the structs at positions start to end as an (end - start, FEATURE_COUNT) array
+# Features: count, mean, spread, min and max of the count differences to the nearest structs,
+# distance to the previous and next struct with the same key (0 if there is none)
+# Counts and distances are log scaled so a feature vector is dominated by neither
+def relation_features(context_relations, start=0, end=None):
+    end = len(context_relations) if end is None else end
+    _, _, count_diff = context_relations.nearest(start, end)
+    positions = np.arange(start, end)
+    previous_same = context_relations.previous_same[start:end]
+    next_same = context_relations.next_same[start:end]
+    return make_features(
+        context_relations.counts[start:end],
+        count_diff,
+        np.where(previous_same >= 0, positions - previous_same, 0),
+        np.where(next_same >= 0, next_same - positions, 0))
+
+# Makes relation features from the counts, (rows, k) count differences and same key distances of each row
+def make_features(counts, count_diff, previous_distances, next_distances):
+    features = np.zeros((len(counts), FEATURE_COUNT), dtype=np.float32)
+    features[:, 0] = np.log1p(counts)
+    if count_diff.shape[1]:
+        features[:, 1] = _signed_log(count_diff.mean(axis=1))
+        features[:, 2] = np.log1p(count_diff.std(axis=1))
+        features[:, 3] = _signed_log(count_diff.min(axis=1))
+        features[:, 4] = _signed_log(count_diff.max(axis=1))
+    features[:, 5] = np.log1p(previous_distances)
+    features[:, 6] = np.log1p(next_distances)
+    return features
+
+def _signed_log(values):
+    return np.sign(values) * np.log1p(np.abs(values))
+
+# Default number of hash tables of a RelationIndex, more tables find more of the nearest candidates but take longer
+RELATION_TABLES = 8
+# Default number of projections hashed together in each table, more projections make smaller buckets
+RELATION_PROJECTIONS = 4
+# Default width of the projection buckets, wider buckets find more candidates
+RELATION_BUCKET_WIDTH = 1.0
+
+# Approximate nearest neighbour index over relation features, finds contextually equivalent structs
+# without comparing against every struct (locality sensitive hashing with p-stable random projections)
+# Each table hashes the features of an entry to a bucket, the candidates of a query are the entries sharing
+# a bucket with it in any table, ranked by their distance to the query
+class RelationIndex:
+    def __init__(self, dimensions=FEATURE_COUNT, tables=RELATION_TABLES, projections=RELATION_PROJECTIONS, width=RELATION_BUCKET_WIDTH, seed=0):
+        rng = np.random.default_rng(seed)
+        self.width = width
+        self.projections = rng.standard_normal((tables, projections, dimensions)).astype(np.float32)
+        self.offsets = rng.uniform(0, width, (tables, projections)).astype(np.float32)
+        # Odd multipliers combining the bucket of each projection into one key per table
+        self.multipliers = rng.integers(0, 1 << 63, projections, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+
+        self.ids = np.zeros(0, dtype=np.int64) # Struct ID of each entry
+        self.features = np.zeros((0, dimensions), dtype=np.float32)
+        self.sorted_keys = [] # Keys of every entry in sorted order, by table
+        self.sorted_entries = [] # Entry of each sorted key, by table
+        self.pending = [] # (IDs, features) added since the tables were last sorted
+
+    def __len__(self):
+        return len(self.ids) + sum(len(ids) for ids, _ in self.pending)
+
+    # Adds the relation features of structs, a struct can be added once for every context it appears in
+    def add(self, ids, features):
+        self.pending.append((np.asarray(ids, dtype=np.int64), np.asarray(features, dtype=np.float32)))
+
+    # Returns the IDs of the structs nearest to each row of features, nearest first, at most limit for each row
+    def query(self, features, limit=None):
+        self._build()
+        features = np.atleast_2d(np.asarray(features, dtype=np.float32))
+        rows = []
+        entries = []
+        for table in range(len(self.sorted_keys)):
+            keys = self._keys(features, table)
+            starts = np.searchsorted(self.sorted_keys[table], keys, 'left')
+            counts = np.searchsorted(self.sorted_keys[table], keys, 'right') - starts
+            rows.append(np.repeat(np.arange(len(features)), counts))
+            entries.append(self.sorted_entries[table][ranges(starts, counts)])
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        entries = np.concatenate(entries) if entries else np.zeros(0, dtype=np.int64)
+
+        # Nearest first within each row, a struct found by several tables or contexts is kept once
+        distances = np.linalg.norm(self.features[entries] - features[rows], axis=1)
+        order = np.lexsort((distances, rows))
+        rows, ids = rows[order], self.ids[entries[order]]
+        _, first = np.unique(rows * (int(self.ids.max(initial=0)) + 1) + ids, return_index=True)
+        first.sort()
+        rows, ids = rows[first], ids[first]
+        matches = np.split(ids, np.searchsorted(rows, np.arange(1, len(features))))
+        return [row_ids[:limit] for row_ids in matches]
+
+    # Returns the key of each row of features in a table
+    def _keys(self, features, table):
+        buckets = np.floor((features @ self.projections[table].T + self.offsets[table]) / self.width).astype(np.int64)
+        return (buckets.astype(np.uint64) * self.multipliers).sum(axis=1, dtype=np.uint64)
+
+    # Sorts the keys of every table again once entries were added
+    def _build(self):
+        if not self.pending and self.sorted_keys:
+            return
+        self.ids = np.concatenate([self.ids] + [ids for ids, _ in self.pending])
+        self.features = np.concatenate([self.features] + [features for _, features in self.pending])
+        self.pending = []
+        self.sorted_keys = []
+        self.sorted_entries = []
+        for table in range(len(self.projections)):
+            keys = self._keys(self.features, table)
+            order = np.argsort(keys, kind='stable')
+            self.sorted_keys.append(keys[order])
+            self.sorted_entries.append(order)
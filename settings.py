@@ -1,36 +1,137 @@
+import configparser
 import os
-from error_handler import handle_errors
-from file_io import write
+from file_io import SYMBOL_WIDTHS, write
+from metrics import METRICS_FORMATS
+
+SETTINGS_SECTION = "settings"
 
 class Settings:
     def __init__(self, file="settings.ini"):
+        self.data_directory = "data"
+        # Watch the data directory for new files when run without a path (manager.py --watch)
+        self.auto_catalog = False
+        # Database compression, level 0 saves the database uncompressed
+        self.compression_level = 0
+        # Uncompressed size of each compressed block of structs, in bytes
+        self.compression_block_size = 1 << 16
+        # Size of the zstd dictionary trained on struct records, 0 disables training
+        self.compression_dict_size = 0
+        # Bytes of decompressed blocks kept in memory
+        self.compression_cache_size = 4 << 20
+        # Bytes of owner lookups (the struct made of given substructs) and struct lookups by values kept in memory
+        self.owner_cache_size = 1 << 20
+        self.struct_cache_size = 1 << 20
+        # Bytes of stored structs kept decoded in memory, structs decoded least recently are decoded again when next used
+        # 0 keeps every decoded struct
+        self.decoded_cache_size = 64 << 20
+        # Bytes of converted segments of data kept in memory across files
+        self.segment_cache_size = 64 << 20
+        # Only keep a new cache entry over older entries which are used less often, so one pass over a large file
+        # does not flush the entries in use (W-TinyLFU admission)
+        self.cache_admission = False
+        # Check the arguments of every database query, can be turned off in production
+        self.validate_queries = True
+        # Append new and replaced structs to a log on save instead of rewriting the database files
+        # The log is folded into the database files by compaction (manager.py --compact)
+        self.append_saves = False
+        # Width in bits of the symbols files are catalogued in: 1 matches bits against the lowest structs,
+        # 8 and 16 look up each byte or pair of bytes, which makes 8 or 16 times fewer leaves in the tree of a file
+        self.symbol_width = 1
+        # Files larger than this many bytes are catalogued one window at a time, 0 reads every file whole
+        self.stream_window_size = 1 << 24
+        # Metrics output after each catalogued file, "json" appends JSON lines and "prometheus" rewrites a Prometheus text file
+        # Empty turns metrics output off
+        self.metrics_format = ""
+        # File in the data directory the metrics are written to, empty uses metrics.jsonl or metrics.prom
+        self.metrics_file = ""
+        # Files or windows of large files read ahead of the catalog by manager.py --pipeline
+        self.pipeline_depth = 4
+        # Files catalogued by manager.py --pipeline between database saves, blueprints are written after each save
+        self.pipeline_save_interval = 64
+        # Seconds between scans of a watched directory
+        self.watch_interval = 5
+        # Seconds a file has to go unmodified before a watched directory catalogs it
+        self.watch_debounce = 2
+        # Files catalogued per batch by a watched directory, the database is saved once per batch
+        self.watch_batch_size = 64
+
+        # No file only gives the default settings
+        if file is None:
+            return
+
         _, ext = os.path.splitext(file)
         if ext.lower() != ".ini":
             raise ValueError("Invalid settings file given")
-        self.data_directory = "data"
-        self.auto_catalog = False
-        
-        default_settings = f"{self.data_directory}\n{str(int(self.auto_catalog))}"
-        
+
         settings_path = os.path.join(os.getcwd(), file)
         if not os.path.exists(settings_path):
-            write(settings_path, default_settings)
+            write(settings_path, self.to_ini())
         self._load_settings(settings_path)
 
-    # TODO: Make this cleaner
-    @handle_errors
+    # Returns the settings in .ini format
+    def to_ini(self):
+        lines = [f"[{SETTINGS_SECTION}]"]
+        for name, value in vars(self).items():
+            if isinstance(value, bool):
+                value = int(value)
+            lines.append(f"{name} = {value}")
+        return "\n".join(lines) + "\n"
+
+    # Every valid setting is read before the invalid ones are raised together, so one bad value does not leave
+    # the settings after it at their defaults
     def _load_settings(self, file):
+        parser = configparser.ConfigParser()
+        try:
+            parser.read(file)
+        except configparser.MissingSectionHeaderError:
+            # Older settings files are a data directory and auto catalog flag on separate lines
+            self._load_legacy_settings(file)
+            return
+
+        if not parser.has_section(SETTINGS_SECTION):
+            return
+        section = parser[SETTINGS_SECTION]
+        errors = []
+        for name, default in vars(self).items():
+            if name not in section:
+                continue
+            try:
+                if isinstance(default, bool):
+                    value = section.getboolean(name)
+                elif isinstance(default, int):
+                    value = section.getint(name)
+                else:
+                    value = section.get(name)
+                self._set(name, value)
+            except ValueError as e:
+                errors.append(f"{name} ({e})")
+        if errors:
+            raise ValueError(f"Invalid settings in {file}: " + ", ".join(errors))
+
+    def _load_legacy_settings(self, file):
         with open(file, 'r') as f:
             lines = f.readlines()
             for i in range(len(lines)):
                 line = lines[i].strip()
                 if line and not line.startswith('#'):
                     if i == 0:
-                        check_path = os.path.join(os.getcwd(), line)
-                        if os.path.exists(line):
-                            self.data_directory = line
-                        else:
-                            raise ValueError("Invalid data directory")
+                        self._set("data_directory", line)
                     if i == 1:
-                        if int(line) != 1:
-                            self.auto_catalog = False
\ No newline at end of file
+                        self._set("auto_catalog", int(line) == 1)
+
+    # Validates and sets a setting
+    # A missing data directory is fine, the database creates it on first run
+    def _set(self, name, value):
+        if name == "data_directory" and os.path.exists(value) and not os.path.isdir(value):
+            raise ValueError("Invalid data directory")
+        if name == "metrics_format" and value and value not in METRICS_FORMATS:
+            raise ValueError("Invalid metrics format")
+        if name == "symbol_width" and value not in SYMBOL_WIDTHS:
+            raise ValueError("Invalid symbol width")
+        if name in ("watch_interval", "watch_debounce") and value < 0:
+            raise ValueError(f"Invalid {name}")
+        if name in ("watch_batch_size", "pipeline_depth", "pipeline_save_interval") and value < 1:
+            raise ValueError(f"Invalid {name}")
+        if name.endswith("_cache_size") and value < 0:
+            raise ValueError(f"Invalid {name}")
+        setattr(self, name, value)
@@ -0,0 +1,370 @@
+from struct import Struct, unpack_from
+import numpy as np
+import zstandard as zstd
+
+# Versions of the Struct Database (SDB) and Pointers (SDBP) file formats
+# v1: every integer is 4 bytes big-endian followed by 4 zero bytes, headers are "SDB"/"SDBP" + zero bytes
+# v2: little-endian, no padding, versioned headers and fixed-width arrays which can be read in place
+SDB_V1 = 1
+SDB_V2 = 2
+SDB_VERSION = SDB_V2
+
+SDB_MAGIC = b"SDB"
+SDBP_MAGIC = b"SDBP"
+
+# v2 header flags
+# Compressed: structs are grouped into blocks, each block is an independent zstd frame
+FLAG_COMPRESSED = 1 << 0
+
+# v2 headers
+# SDB: magic, version, flags, reserved
+SDB_HEADER = Struct('<3sBB3x')
+# SDBP: magic, version, flags, reserved, struct count
+SDBP_HEADER = Struct('<4sBB2xI4x')
+
+# v2 struct record: id, type, base struct id, substruct count, value count
+# Followed by substruct IDs (u32 each) and values (u32 each)
+RECORD_HEADER = Struct('<IBIII')
+ID_DTYPE = np.dtype('<u4')
+INDEX_DTYPE = np.dtype('<u8')
+
+# Compressed SDB: dictionary size, then the dictionary (if any), then the frames
+DICT_HEADER = Struct('<I4x')
+# Compressed SDBP: frame count, then the frame byte indexes in the SDB (frame count + 1 entries)
+FRAME_TABLE_HEADER = Struct('<I4x')
+# Records used to train a compression dictionary are sampled up to this many
+DICT_SAMPLE_LIMIT = 100000
+
+# Returns the format version of SDB or SDBP bytes
+# v1 headers are followed by zero bytes, so a zero version byte means v1
+def get_version(data, magic=SDB_MAGIC):
+    if len(data) <= len(magic) or bytes(data[:len(magic)]) != magic:
+        raise ValueError("Invalid Database or Pointer file.")
+    version = data[len(magic)]
+    return version if version else SDB_V1
+
+# Returns the flags of v2 SDB or SDBP bytes
+def get_flags(data, magic=SDB_MAGIC):
+    return data[len(magic) + 1]
+
+def sdb_header(flags=0):
+    return SDB_HEADER.pack(SDB_MAGIC, SDB_V2, flags)
+
+def sdbp_header(count, flags=0):
+    return SDBP_HEADER.pack(SDBP_MAGIC, SDB_V2, flags, count)
+
+# Packs a single struct record
+def pack_record(id, type, base, substructs, values):
+    data = bytearray(RECORD_HEADER.pack(id, type, base, len(substructs), len(values)))
+    data.extend(np.asarray(substructs, dtype=ID_DTYPE).tobytes())
+    data.extend(np.asarray(values, dtype=ID_DTYPE).tobytes())
+    return data
+
+# Unpacks a struct record at offset without copying the surrounding buffer
+# Returns (id, type, base, substruct IDs, values)
+def unpack_record(data, offset):
+    id, type, base, substruct_count, value_count = RECORD_HEADER.unpack_from(data, offset)
+    offset += RECORD_HEADER.size
+    substructs = np.frombuffer(data, ID_DTYPE, substruct_count, offset).tolist()
+    offset += substruct_count * ID_DTYPE.itemsize
+    values = np.frombuffer(data, ID_DTYPE, value_count, offset).tolist()
+    return id, type, base, substructs, values
+
+# Unpacks a v1 struct record at offset, every field is a 4 byte integer followed by 4 zero bytes
+# Returns (id, type, base, substruct IDs, values)
+def unpack_record_v1(data, offset):
+    id, substruct_count = unpack_from('>I4xI', data, offset)
+    substructs_start = offset + 16
+    substructs = list(unpack_from(f'>{substruct_count * 2}I', data, substructs_start)[::2])
+    substructs_end = substructs_start + substruct_count * 8
+    
+    type, value_count = unpack_from('>I4xI', data, substructs_end)
+    
+    values_start = substructs_end + 16
+    values = list(unpack_from(f'>{value_count * 2}I', data, values_start)[::2])
+    values_end = values_start + value_count * 8
+    
+    base = unpack_from('>I', data, values_end)[0]
+    return id, type, base, substructs, values
+
+# Packs the pointer file from struct IDs and their byte indexes in the database file
+# Sections: header, byte indexes (u64), struct IDs (u32)
+# Compressed files add the frame of each struct (u32) and the frame table, byte indexes are then relative to the frame
+def pack_pointers(ids, byte_indexes, frames=None, frame_indexes=None):
+    flags = FLAG_COMPRESSED if frames is not None else 0
+    data = bytearray(sdbp_header(len(ids), flags))
+    data.extend(np.asarray(byte_indexes, dtype=INDEX_DTYPE).tobytes())
+    data.extend(np.asarray(ids, dtype=ID_DTYPE).tobytes())
+    if flags & FLAG_COMPRESSED:
+        data.extend(np.asarray(frames, dtype=ID_DTYPE).tobytes())
+        data.extend(FRAME_TABLE_HEADER.pack(len(frame_indexes) - 1))
+        data.extend(np.asarray(frame_indexes, dtype=INDEX_DTYPE).tobytes())
+    return data
+
+# Returns (struct IDs, byte indexes, frames, frame byte indexes) as views into the pointer bytes
+# Frames are None for uncompressed files
+def unpack_pointers(data):
+    _, _, flags, count = SDBP_HEADER.unpack_from(data, 0)
+    offset = SDBP_HEADER.size
+    byte_indexes = np.frombuffer(data, INDEX_DTYPE, count, offset)
+    offset += count * INDEX_DTYPE.itemsize
+    ids = np.frombuffer(data, ID_DTYPE, count, offset)
+    offset += count * ID_DTYPE.itemsize
+    if not flags & FLAG_COMPRESSED:
+        return ids, byte_indexes, None, None
+    
+    frames = np.frombuffer(data, ID_DTYPE, count, offset)
+    offset += count * ID_DTYPE.itemsize
+    frame_count = FRAME_TABLE_HEADER.unpack_from(data, offset)[0]
+    offset += FRAME_TABLE_HEADER.size
+    frame_indexes = np.frombuffer(data, INDEX_DTYPE, frame_count + 1, offset)
+    return ids, byte_indexes, frames, frame_indexes
+
+# Trains a zstd dictionary on struct records, returns None if there are too few records to train on
+def train_dictionary(records, dict_size):
+    samples = [bytes(record) for record in records[:DICT_SAMPLE_LIMIT]]
+    try:
+        return zstd.train_dictionary(dict_size, samples)
+    except zstd.ZstdError:
+        return None
+
+# Packs struct records into a compressed SDB
+# Records are grouped into blocks of about block_size bytes and each block is compressed as its own frame
+# Returns (SDB bytes, frame of each record, byte index of each record in its frame, frame byte indexes)
+def pack_compressed(records, level, block_size, dict_size=0):
+    dictionary = train_dictionary(records, dict_size) if dict_size else None
+    dict_data = dictionary.as_bytes() if dictionary else b""
+    compressor = zstd.ZstdCompressor(level=level, dict_data=dictionary) if dictionary else zstd.ZstdCompressor(level=level)
+    
+    data = bytearray(sdb_header(FLAG_COMPRESSED))
+    data.extend(DICT_HEADER.pack(len(dict_data)))
+    data.extend(dict_data)
+    
+    frames = []
+    byte_indexes = []
+    frame_indexes = [len(data)]
+    block = bytearray()
+    for record in records:
+        frames.append(len(frame_indexes) - 1)
+        byte_indexes.append(len(block))
+        block.extend(record)
+        if len(block) >= block_size:
+            data.extend(compressor.compress(bytes(block)))
+            frame_indexes.append(len(data))
+            block = bytearray()
+    if block:
+        data.extend(compressor.compress(bytes(block)))
+        frame_indexes.append(len(data))
+    
+    return data, frames, byte_indexes, frame_indexes
+
+# Reads struct records from an uncompressed SDB
+class PlainRecords:
+    def __init__(self, db_bytes, byte_indexes, unpack_record=unpack_record):
+        self.db_bytes = db_bytes
+        self.byte_indexes = byte_indexes
+        self.unpack_record = unpack_record # unpack_record or unpack_record_v1
+    
+    def __len__(self):
+        return len(self.byte_indexes)
+    
+    # Returns (id, type, base, substruct IDs, values) of the struct with the given ID
+    def unpack(self, index):
+        return self.unpack_record(self.db_bytes, int(self.byte_indexes[index]))
+
+# Reads struct records from a compressed SDB, only the frame holding a record is decompressed
+# Decompressed frames are kept in the given cache (get/put by frame number)
+class FrameRecords:
+    def __init__(self, db_bytes, byte_indexes, frames, frame_indexes, cache):
+        self.db_bytes = db_bytes
+        self.byte_indexes = byte_indexes
+        self.frames = frames
+        self.frame_indexes = frame_indexes
+        self.cache = cache
+        
+        dict_size = DICT_HEADER.unpack_from(db_bytes, SDB_HEADER.size)[0]
+        if dict_size:
+            dict_start = SDB_HEADER.size + DICT_HEADER.size
+            dictionary = zstd.ZstdCompressionDict(bytes(db_bytes[dict_start:dict_start + dict_size]))
+            self.decompressor = zstd.ZstdDecompressor(dict_data=dictionary)
+        else:
+            self.decompressor = zstd.ZstdDecompressor()
+    
+    def __len__(self):
+        return len(self.byte_indexes)
+    
+    # Returns (id, type, base, substruct IDs, values) of the struct with the given ID
+    def unpack(self, index):
+        frame = int(self.frames[index])
+        frame_data = self.cache.get(frame)
+        if frame_data is None:
+            start = int(self.frame_indexes[frame])
+            end = int(self.frame_indexes[frame + 1])
+            frame_data = self.decompressor.decompress(self.db_bytes[start:end])
+            self.cache.put(frame, frame_data)
+        return unpack_record(frame_data, int(self.byte_indexes[index]))
+
+# Value hash index file (SDBH), stored next to the database
+# Sections: header, all hashes in sorted order (u64), the struct ID of each sorted hash (u32),
+# value length of each struct by ID (u32, or u64 if a length does not fit)
+# The hash of each struct by ID is the sorted hashes placed at their IDs, so it is not stored
+SDBH_MAGIC = b"SDBH"
+# SDBH: magic, version, bytes per length, reserved, struct count
+# Files written with the hash of each struct by ID have 0 bytes per length, they are rebuilt
+SDBH_HEADER = Struct('<4sBB2xI4x')
+HASH_DTYPE = np.dtype('<u8')
+# Lengths are written as u32 if they all fit, as u64 otherwise
+LENGTH_DTYPES = {4: np.dtype('<u4'), 8: INDEX_DTYPE}
+
+def pack_value_index(hashes, lengths):
+    hashes = np.asarray(hashes, dtype=HASH_DTYPE)
+    lengths = np.asarray(lengths, dtype=INDEX_DTYPE)
+    order = np.argsort(hashes, kind='stable')
+    length_dtype = LENGTH_DTYPES[4 if lengths.max(initial=0) <= np.iinfo(np.uint32).max else 8]
+    data = bytearray(SDBH_HEADER.pack(SDBH_MAGIC, SDB_V2, length_dtype.itemsize, len(hashes)))
+    data.extend(hashes[order].tobytes())
+    data.extend(order.astype(ID_DTYPE).tobytes())
+    data.extend(lengths.astype(length_dtype).tobytes())
+    return data
+
+# Returns (sorted hashes, sorted IDs, lengths) as views into the index bytes, or None if the file has an older layout
+def unpack_value_index(data):
+    magic, _, length_bytes, count = SDBH_HEADER.unpack_from(data, 0)
+    if magic != SDBH_MAGIC:
+        raise ValueError("Invalid value index file.")
+    if length_bytes not in LENGTH_DTYPES:
+        return None
+    offset = SDBH_HEADER.size
+    sorted_hashes = np.frombuffer(data, HASH_DTYPE, count, offset)
+    offset += count * HASH_DTYPE.itemsize
+    sorted_ids = np.frombuffer(data, ID_DTYPE, count, offset)
+    offset += count * ID_DTYPE.itemsize
+    lengths = np.frombuffer(data, LENGTH_DTYPES[length_bytes], count, offset)
+    return sorted_hashes, sorted_ids, lengths
+
+# Append-only log segment, holds the structs saved since the base files were last rewritten
+# database.sdbl: SDB header followed by v2 records
+# pointers.sdbpl: SDBP header followed by (struct ID, byte index in database.sdbl) entries
+# values.sdbhl: SDBH header followed by (struct ID, value hash, value length) entries
+# Entries for an ID replace earlier entries for the same ID, in the log or in the base files
+LOG_POINTER_DTYPE = np.dtype([('id', '<u4'), ('index', '<u8')])
+LOG_VALUE_DTYPE = np.dtype([('id', '<u4'), ('hash', '<u8'), ('length', '<u8')])
+
+def log_headers():
+    return sdb_header(), sdbp_header(0), SDBH_HEADER.pack(SDBH_MAGIC, SDB_V2, 0, 0)
+
+def pack_log_pointers(ids, byte_indexes):
+    entries = np.empty(len(ids), dtype=LOG_POINTER_DTYPE)
+    entries['id'] = ids
+    entries['index'] = byte_indexes
+    return entries.tobytes()
+
+# Returns (struct IDs, byte indexes) of the log pointer entries, a partially written last entry is ignored
+def unpack_log_pointers(data):
+    count = (len(data) - SDBP_HEADER.size) // LOG_POINTER_DTYPE.itemsize
+    entries = np.frombuffer(data, LOG_POINTER_DTYPE, count, SDBP_HEADER.size)
+    return entries['id'], entries['index']
+
+def pack_log_values(ids, hashes, lengths):
+    entries = np.empty(len(ids), dtype=LOG_VALUE_DTYPE)
+    entries['id'] = ids
+    entries['hash'] = hashes
+    entries['length'] = lengths
+    return entries.tobytes()
+
+# Returns (struct IDs, value hashes, value lengths) of the log value entries
+def unpack_log_values(data):
+    count = (len(data) - SDBH_HEADER.size) // LOG_VALUE_DTYPE.itemsize
+    entries = np.frombuffer(data, LOG_VALUE_DTYPE, count, SDBH_HEADER.size)
+    return entries['id'], entries['hash'], entries['length']
+
+# Reads struct records from the log, falling back to the base records for IDs which are not in the log
+class LogRecords:
+    def __init__(self, base, log_bytes, ids, byte_indexes):
+        self.base = base
+        self.log_bytes = log_bytes
+        base_count = len(base) if base else 0
+        self.count = max(base_count, int(ids.max()) + 1)
+        # Byte index of the latest log record of each ID, -1 for IDs read from the base records
+        last = len(ids) - 1 - np.unique(ids[::-1], return_index=True)[1]
+        self.log_indexes = np.full(self.count, -1, dtype=np.int64)
+        self.log_indexes[ids[last]] = byte_indexes[last]
+    
+    def __len__(self):
+        return self.count
+    
+    # Returns (id, type, base, substruct IDs, values) of the struct with the given ID
+    def unpack(self, index):
+        byte_index = int(self.log_indexes[index])
+        if byte_index < 0:
+            return self.base.unpack(index)
+        return unpack_record(self.log_bytes, byte_index)
+
+# ID remap file (SDBR), one table per compaction mapping the struct IDs before the compaction to the IDs after it
+# Sections: header, then for each table its length and first old ID (u32 each) and the new ID of each old ID from there (u32)
+# Old IDs outside a table keep their ID, files written with whole tables have 0 as the first old ID
+SDBR_MAGIC = b"SDBR"
+SDBR_HEADER = Struct('<4sB3x')
+REMAP_TABLE_HEADER = Struct('<II')
+
+def sdbr_header():
+    return SDBR_HEADER.pack(SDBR_MAGIC, SDB_V2)
+
+def pack_remap_table(new_ids, first=0):
+    return REMAP_TABLE_HEADER.pack(len(new_ids), first) + np.asarray(new_ids, dtype=ID_DTYPE).tobytes()
+
+# Returns the (first old ID, new IDs) of each remap table, the new IDs as views into the remap bytes
+def unpack_remap_tables(data):
+    magic, _ = SDBR_HEADER.unpack_from(data, 0)
+    if magic != SDBR_MAGIC:
+        raise ValueError("Invalid remap file.")
+    tables = []
+    offset = SDBR_HEADER.size
+    while offset + REMAP_TABLE_HEADER.size <= len(data):
+        count, first = REMAP_TABLE_HEADER.unpack_from(data, offset)
+        offset += REMAP_TABLE_HEADER.size
+        tables.append((first, np.frombuffer(data, ID_DTYPE, count, offset)))
+        offset += count * ID_DTYPE.itemsize
+    return tables
+
+# Substruct index file (SDBS), maps the ordered child IDs of structs to struct IDs
+# Sections: header, the key of each struct with children in sorted order (u64), the struct ID of each sorted key (u32)
+# Keys are 64-bit hashes of the child IDs, structs found by key are checked against their children
+SDBS_MAGIC = b"SDBS"
+# SDBS: magic, version, reserved, struct count of the database, key count
+SDBS_HEADER = Struct('<4sB3xII')
+KEY_DTYPE = np.dtype('<u8')
+# substructs.sdbsl: SDBS header followed by (struct ID, key) entries of the structs saved to the log
+LOG_SUBSTRUCT_DTYPE = np.dtype([('id', '<u4'), ('key', '<u8')])
+
+def sdbs_header(struct_count=0, key_count=0):
+    return SDBS_HEADER.pack(SDBS_MAGIC, SDB_V2, struct_count, key_count)
+
+def pack_substruct_index(struct_count, sorted_keys, sorted_ids):
+    data = bytearray(sdbs_header(struct_count, len(sorted_keys)))
+    data.extend(np.asarray(sorted_keys, dtype=KEY_DTYPE).tobytes())
+    data.extend(np.asarray(sorted_ids, dtype=ID_DTYPE).tobytes())
+    return data
+
+# Returns (struct count, sorted keys, sorted IDs) with the arrays as views into the index bytes
+def unpack_substruct_index(data):
+    magic, _, struct_count, count = SDBS_HEADER.unpack_from(data, 0)
+    if magic != SDBS_MAGIC:
+        raise ValueError("Invalid substruct index file.")
+    offset = SDBS_HEADER.size
+    sorted_keys = np.frombuffer(data, KEY_DTYPE, count, offset)
+    offset += count * KEY_DTYPE.itemsize
+    sorted_ids = np.frombuffer(data, ID_DTYPE, count, offset)
+    return struct_count, sorted_keys, sorted_ids
+
+def pack_log_substructs(ids, keys):
+    entries = np.empty(len(ids), dtype=LOG_SUBSTRUCT_DTYPE)
+    entries['id'] = ids
+    entries['key'] = keys
+    return entries.tobytes()
+
+# Returns (struct IDs, keys) of the log substruct entries
+def unpack_log_substructs(data):
+    count = (len(data) - SDBS_HEADER.size) // LOG_SUBSTRUCT_DTYPE.itemsize
+    entries = np.frombuffer(data, LOG_SUBSTRUCT_DTYPE, count, SDBS_HEADER.size)
+    return entries['id'], entries['key']
@@ -0,0 +1,436 @@
+import numpy as np
+from cache import ENTRY_BYTES, Cache
+
+# Type code of reserved IDs which have no struct yet
+EMPTY_TYPE = 0xFE
+# Type code of stored structs which are not decoded yet
+UNLOADED_TYPE = 0xFF
+# Length of structs which children are not all loaded yet
+UNKNOWN_LENGTH = np.iinfo(np.uint64).max
+# Structs longer than this are expanded a tree level at a time with array operations instead of one struct at a time
+VECTOR_EXPAND_LENGTH = 1 << 12
+# Subtrees up to this length are expanded once per level when they appear more than once
+SHARED_EXPAND_LENGTH = 1 << 5
+# Number of values streamed at a time by iter_value_chunks
+EXPAND_CHUNK_LENGTH = 1 << 20
+# Number of stored structs decoded at a time when loading every struct
+LOAD_BATCH_SIZE = 1 << 16
+# Bytes of each child ID and value in the pools
+ITEM_BYTES = 4
+
+# Returns the positions of the given (start, count) ranges back to back
+def ranges(starts, counts):
+    offsets = np.cumsum(counts, dtype=np.int64) - counts
+    return np.repeat(starts - offsets, counts) + np.arange(int(counts.sum()))
+
+# Numpy array with amortized appends, only the first count items are in use
+class GrowableArray:
+    def __init__(self, dtype, capacity=0):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, capacity):
+        if capacity > len(self.data):
+            data = np.empty(max(capacity, 2 * len(self.data), 16), dtype=self.data.dtype)
+            data[:self.count] = self.data[:self.count]
+            self.data = data
+
+    # Appends values, returns the index of the first one
+    def extend(self, values):
+        start = self.count
+        self.reserve(start + len(values))
+        self.data[start:start + len(values)] = values
+        self.count += len(values)
+        return start
+
+    def view(self):
+        return self.data[:self.count]
+
+# Structs as parallel arrays indexed by struct ID, the children and leaf values of every struct are ranges in shared pools
+# Stored structs are copied from the record reader into the arrays the first time they are accessed
+# With a decoded cache, stored structs evicted from it are unloaded again by trim and decoded again when next accessed
+class StructStore:
+    def __init__(self, records=None):
+        self.records = records # Record reader of the database files, None once every struct is loaded
+        self.count = 0
+        self.types = np.empty(0, dtype=np.uint8)
+        self.bases = np.empty(0, dtype=np.uint32)
+        self.child_starts = np.empty(0, dtype=np.int64)
+        self.child_counts = np.empty(0, dtype=np.uint32)
+        self.value_starts = np.empty(0, dtype=np.int64)
+        self.value_counts = np.empty(0, dtype=np.uint32)
+        self.lengths = np.empty(0, dtype=np.uint64) # Number of values of each struct with its children expanded
+        self.children = GrowableArray(np.uint32) # Child struct IDs of every struct
+        self.values = GrowableArray(np.uint32) # Leaf values of every struct
+        self.relations = {} # StructRelations by struct ID, only for structs which have them
+        self.decoded = None # Cache of the decoded stored structs, None keeps every decoded struct
+        self.unloading = set() # Decoded stored structs evicted from the decoded cache, unloaded by trim
+        self.unused_items = 0 # Pool items of unloaded structs, dropped once they are half of the pools
+
+        stored_count = len(records) if records else 0
+        self._reserve(stored_count)
+        self.count = stored_count
+        self.types[:stored_count] = UNLOADED_TYPE
+        self.lengths[:stored_count] = UNKNOWN_LENGTH
+
+    def __len__(self):
+        return self.count
+
+    def _reserve(self, capacity):
+        if capacity <= len(self.types):
+            return
+        capacity = max(capacity, 2 * len(self.types), 16)
+        for name in ('types', 'bases', 'child_starts', 'child_counts', 'value_starts', 'value_counts', 'lengths'):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            setattr(self, name, grown)
+
+    # Reserves an ID without a struct
+    def reserve_id(self):
+        id = self.count
+        self._reserve(id + 1)
+        self.count += 1
+        self.types[id] = EMPTY_TYPE
+        return id
+
+    # Adds a struct, a base of None refers to the struct itself
+    def add(self, type, base, children, values):
+        id = self.reserve_id()
+        self.set(id, type, base, children, values)
+        return id
+
+    # Adds structs made of (left, right) pairs of child IDs, returns the ID of the first one
+    def add_pairs(self, type, left, right):
+        count = len(left)
+        first_id = self.count
+        self._reserve(first_id + count)
+        ids = np.arange(first_id, first_id + count)
+        pairs = np.empty(2 * count, dtype=np.uint32)
+        pairs[0::2] = left
+        pairs[1::2] = right
+        start = self.children.extend(pairs)
+
+        self.types[ids] = type
+        self.bases[ids] = ids
+        self.child_starts[ids] = start + 2 * np.arange(count)
+        self.child_counts[ids] = 2
+        self.value_starts[ids] = 0
+        self.value_counts[ids] = 0
+        left_lengths, right_lengths = self.lengths[left], self.lengths[right]
+        self.lengths[ids] = np.where((left_lengths == UNKNOWN_LENGTH) | (right_lengths == UNKNOWN_LENGTH),
+                                     UNKNOWN_LENGTH, left_lengths + right_lengths)
+        self.count += count
+        return first_id
+
+    # Bounds the decoded stored structs to a byte budget, 0 keeps every decoded struct
+    def set_decoded_cache(self, max_bytes, admission=False):
+        self.decoded = None
+        if max_bytes and self.records is not None:
+            self.decoded = Cache(max_bytes, 'decoded_struct', admission, lambda id, size: size, lambda id, size: self.unloading.add(id))
+
+    # Sets the fields of a struct, replaced children and values are left unused in the pools until reorder
+    def set(self, id, type, base, children, values):
+        if self.decoded is not None:
+            # Replaced stored structs are only in the arrays, so they are never unloaded
+            self.decoded.discard(id)
+            self.unloading.discard(id)
+        self.types[id] = type
+        self.bases[id] = id if base is None else base
+        self.child_starts[id] = self.children.extend(children)
+        self.child_counts[id] = len(children)
+        self.value_starts[id] = self.values.extend(values)
+        self.value_counts[id] = len(values)
+        # Computed from the children, unless one of them is not loaded yet
+        if len(values) or not len(children):
+            self.lengths[id] = len(values)
+        else:
+            child_lengths = self.lengths[np.asarray(children, dtype=np.int64)]
+            self.lengths[id] = UNKNOWN_LENGTH if (child_lengths == UNKNOWN_LENGTH).any() else child_lengths.sum()
+
+    # Copies a stored struct from the record reader into the arrays, an access to a decoded one is recorded in the decoded cache
+    def ensure(self, id):
+        if self.records is not None:
+            if self.types[id] == UNLOADED_TYPE:
+                self.load_many([id])
+            elif self.decoded is not None:
+                self.decoded.touch(id)
+
+    # Copies stored structs from the record reader into the arrays in one go, lengths already known are kept
+    def load_many(self, ids):
+        fields = [self.records.unpack(id) for id in ids]
+        ids = np.asarray(ids, dtype=np.int64)
+        child_lists = [field[3] for field in fields]
+        value_lists = [field[4] for field in fields]
+        child_counts = np.fromiter(map(len, child_lists), dtype=np.uint32, count=len(ids))
+        value_counts = np.fromiter(map(len, value_lists), dtype=np.uint32, count=len(ids))
+
+        self.types[ids] = [field[1] for field in fields]
+        self.bases[ids] = [field[2] for field in fields]
+        start = self.children.extend(np.fromiter((child for children in child_lists for child in children), dtype=np.uint32))
+        self.child_starts[ids] = start + np.cumsum(child_counts, dtype=np.int64) - child_counts
+        self.child_counts[ids] = child_counts
+        start = self.values.extend(np.fromiter((value for values in value_lists for value in values), dtype=np.uint32))
+        self.value_starts[ids] = start + np.cumsum(value_counts, dtype=np.int64) - value_counts
+        self.value_counts[ids] = value_counts
+        leaves = ids[(value_counts > 0) | (child_counts == 0)]
+        self.lengths[leaves] = self.value_counts[leaves]
+        if self.decoded is not None:
+            sizes = ENTRY_BYTES + ITEM_BYTES * (child_counts.astype(np.int64) + value_counts)
+            put, max_bytes = self.decoded.put, self.decoded.max_bytes
+            for id, size in zip(ids.tolist(), sizes.tolist()):
+                if size > max_bytes:
+                    # Not cached, larger than the whole budget
+                    self.unloading.add(id)
+                else:
+                    put(id, size)
+
+    # Unloads the decoded structs evicted from the decoded cache, their lengths are kept
+    # Called between operations on the store, views and IDs held by callers stay valid as structs are decoded again on access
+    def trim(self):
+        if not self.unloading:
+            return
+        ids = np.fromiter(self.unloading, dtype=np.int64, count=len(self.unloading))
+        self.unloading.clear()
+        self.types[ids] = UNLOADED_TYPE
+        self.unused_items += int(self.child_counts[ids].sum()) + int(self.value_counts[ids].sum())
+        if 2 * self.unused_items > len(self.children) + len(self.values):
+            self._pack_pools()
+
+    # Rebuilds the pools with the children and values of the structs in the arrays only
+    def _pack_pools(self):
+        loaded = np.flatnonzero(self.types[:self.count] != UNLOADED_TYPE)
+        for pool_name, starts_name, counts_name in (('children', 'child_starts', 'child_counts'), ('values', 'value_starts', 'value_counts')):
+            starts = getattr(self, starts_name)
+            starts[loaded], _, items = self._gather(getattr(self, pool_name), starts[loaded], getattr(self, counts_name)[loaded])
+            pool = GrowableArray(np.uint32)
+            pool.extend(items)
+            setattr(self, pool_name, pool)
+        self.unused_items = 0
+
+    # Sets the lengths of stored structs which are not loaded yet, lengths[id] is the length of each struct
+    def seed_lengths(self, lengths):
+        count = min(len(lengths), self.count)
+        unknown = self.lengths[:count] == UNKNOWN_LENGTH
+        self.lengths[:count][unknown] = lengths[:count][unknown]
+
+    def is_empty(self, id):
+        return self.types[id] == EMPTY_TYPE
+
+    # Returns the child IDs of a struct as an array view
+    def get_children(self, id):
+        self.ensure(id)
+        start = self.child_starts[id]
+        return self.children.data[start:start + self.child_counts[id]]
+
+    # Returns the child IDs of the given structs back to back, with the number of children of each struct
+    def gather_children(self, ids):
+        self._ensure_many(ids)
+        counts = self.child_counts[ids]
+        return self.children.data[ranges(self.child_starts[ids], counts)], counts
+
+    # Returns whether each struct is made of exactly the (left, right) pair of children at the same position
+    def has_pairs(self, ids, left, right):
+        self._ensure_many(ids)
+        starts = self.child_starts[ids]
+        pairs = self.child_counts[ids] == 2
+        if not pairs.any():
+            return pairs
+        starts[~pairs] = starts[pairs][0]
+        children = self.children.data
+        return pairs & (children[starts] == left) & (children[starts + 1] == right)
+
+    # Returns the leaf values of a struct as an array view
+    def get_values(self, id):
+        self.ensure(id)
+        start = self.value_starts[id]
+        return self.values.data[start:start + self.value_counts[id]]
+
+    # Returns the number of values of a struct with its children expanded
+    def length(self, id):
+        lengths = self.lengths
+        stack = [id]
+        while lengths[id] == UNKNOWN_LENGTH:
+            top = stack[-1]
+            self.ensure(top)
+            if lengths[top] != UNKNOWN_LENGTH:
+                stack.pop()
+                continue
+            children = self.get_children(top)
+            missing = [child for child in children.tolist() if lengths[child] == UNKNOWN_LENGTH]
+            if missing:
+                stack.extend(missing)
+            else:
+                lengths[top] = lengths[children].sum()
+                stack.pop()
+        return int(lengths[id])
+
+    # Returns the lengths of every struct, loading them all
+    def all_lengths(self):
+        self.load_all()
+        for id in np.flatnonzero(self.lengths[:self.count] == UNKNOWN_LENGTH).tolist():
+            self.length(id)
+        return self.lengths[:self.count]
+
+    # Yields the values of a struct with every child expanded, in order, without building the full list
+    def iter_values(self, id):
+        stack = [id]
+        while stack:
+            id = stack.pop()
+            self.ensure(id)
+            child_count = self.child_counts[id]
+            if self.value_counts[id] or not child_count:
+                yield from self.get_values(id).tolist()
+            else:
+                start = self.child_starts[id]
+                stack.extend(self.children.data[start:start + child_count][::-1].tolist())
+
+    # Yields the values of a struct in order as arrays of at most EXPAND_CHUNK_LENGTH values (unless a single leaf is longer)
+    # The top of the tree is walked with an explicit stack, subtrees which fit in a chunk are expanded whole
+    def iter_value_chunks(self, id, chunk_length=EXPAND_CHUNK_LENGTH):
+        stack = [id]
+        while stack:
+            # Only IDs are kept between chunks, so the structs decoded for earlier chunks can be unloaded
+            self.trim()
+            id = stack.pop()
+            self.ensure(id)
+            if self.length(id) <= chunk_length or self.value_counts[id] or not self.child_counts[id]:
+                yield self.expand_array(id)
+            else:
+                stack.extend(self.get_children(id)[::-1].tolist())
+
+    # Returns the values of a struct with every child expanded, in order, as an array
+    def expand_array(self, id):
+        output = np.empty(self.length(id), dtype=self.values.data.dtype)
+        self._expand_into(output, np.array([id], dtype=np.int64), np.zeros(1, dtype=np.int64))
+        return output
+
+    # Returns the expanded values of each of the given structs as lists, expanding them all together
+    def expand_many(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        lengths = self._lengths_of(ids)
+        ends = np.cumsum(lengths)
+        output = np.empty(int(ends[-1]) if len(ends) else 0, dtype=self.values.data.dtype)
+        self._expand_into(output, ids, ends - lengths)
+        return [values.tolist() for values in np.split(output, ends[:-1])]
+
+    # Writes the expanded values of structs to output at the given offsets
+    # Expands one tree level at a time, the output offset of each child comes from the lengths of the children before it
+    # Leaves are written to the output at their offsets, so every level only handles the structs on it
+    # Short subtrees which appear more than once on a level are expanded once and copied to each of their offsets
+    def _expand_into(self, output, frontier, offsets):
+        lengths = self._lengths_of(frontier)
+        while len(frontier):
+            self._ensure_many(frontier)
+            child_counts = self.child_counts[frontier]
+            value_counts = self.value_counts[frontier]
+            leaf = (value_counts > 0) | (child_counts == 0)
+            leaves = frontier[leaf]
+            output[ranges(offsets[leaf], value_counts[leaf])] = \
+                self.values.data[ranges(self.value_starts[leaves], value_counts[leaf])]
+            internal = ~leaf
+            
+            short = internal & (lengths <= SHARED_EXPAND_LENGTH)
+            if short.any():
+                shared, inverse = np.unique(frontier[short], return_inverse=True)
+                if len(shared) < len(inverse):
+                    shared_lengths = self._lengths_of(shared)
+                    shared_offsets = np.cumsum(shared_lengths) - shared_lengths
+                    shared_output = np.empty(int(shared_lengths.sum()), dtype=output.dtype)
+                    self._expand_into(shared_output, shared, shared_offsets)
+                    output[ranges(offsets[short], lengths[short])] = \
+                        shared_output[ranges(shared_offsets[inverse], lengths[short])]
+                    internal &= ~short
+            
+            counts = child_counts[internal]
+            children = self.children.data[ranges(self.child_starts[frontier[internal]], counts)].astype(np.int64)
+            child_lengths = self._lengths_of(children)
+            # Offset of each child from the start of its parent
+            child_offsets = np.cumsum(child_lengths) - child_lengths
+            child_offsets -= np.repeat(child_offsets[np.cumsum(counts, dtype=np.int64) - counts], counts)
+            offsets = np.repeat(offsets[internal], counts) + child_offsets
+            frontier = children
+            lengths = child_lengths
+
+    # Returns the lengths of the given structs as an array
+    def _lengths_of(self, ids):
+        lengths = self.lengths[ids]
+        unknown = lengths == UNKNOWN_LENGTH
+        if unknown.any():
+            for id in np.unique(ids[unknown]).tolist():
+                self.length(id)
+            lengths = self.lengths[ids]
+        return lengths.astype(np.int64)
+
+    # Copies the stored structs among the given IDs into the arrays
+    def _ensure_many(self, ids):
+        if self.records is not None:
+            is_unloaded = self.types[ids] == UNLOADED_TYPE
+            if self.decoded is not None:
+                touch = self.decoded.touch
+                for id in np.unique(ids[~is_unloaded]).tolist():
+                    touch(id)
+            unloaded = np.unique(ids[is_unloaded])
+            if len(unloaded):
+                self.load_many(unloaded.tolist())
+
+    # Returns the values of a struct with every child expanded, in order
+    def expand(self, id):
+        if self.length(id) > VECTOR_EXPAND_LENGTH:
+            return self.expand_array(id).tolist()
+        child_starts, child_counts = self.child_starts, self.child_counts
+        value_starts, value_counts = self.value_starts, self.value_counts
+        children, leaf_values = self.children.data, self.values.data
+        values = []
+        stack = [id]
+        while stack:
+            id = stack.pop()
+            if self.records is not None:
+                # Loading a struct can grow the pools
+                self.ensure(id)
+                children, leaf_values = self.children.data, self.values.data
+            child_count = child_counts[id]
+            if value_counts[id] or not child_count:
+                start = value_starts[id]
+                values.extend(leaf_values[start:start + value_counts[id]].tolist())
+            else:
+                start = child_starts[id]
+                stack.extend(children[start:start + child_count][::-1].tolist())
+        return values
+
+    # Copies every stored struct into the arrays and drops the record reader
+    def load_all(self):
+        self.decoded = None
+        self.unloading.clear()
+        if self.records is not None:
+            for start in range(0, self.count, LOAD_BATCH_SIZE):
+                self._ensure_many(np.arange(start, min(start + LOAD_BATCH_SIZE, self.count)))
+        self.records = None
+
+    # Renumbers the structs, old_ids[new_id] is the previous ID of each struct
+    # Children and bases are remapped and the pools are rebuilt without unused entries
+    def reorder(self, old_ids):
+        self.load_all()
+        old_ids = np.asarray(old_ids, dtype=np.int64)
+        new_ids = np.empty(self.count, dtype=np.uint32)
+        new_ids[old_ids] = np.arange(len(old_ids), dtype=np.uint32)
+
+        self.types = self.types[old_ids]
+        self.lengths = self.lengths[old_ids]
+        self.bases = new_ids[self.bases[old_ids]]
+        self.child_starts, self.child_counts, children = self._gather(self.children, self.child_starts[old_ids], self.child_counts[old_ids])
+        self.value_starts, self.value_counts, values = self._gather(self.values, self.value_starts[old_ids], self.value_counts[old_ids])
+        self.children = GrowableArray(np.uint32)
+        self.children.extend(new_ids[children])
+        self.values = GrowableArray(np.uint32)
+        self.values.extend(values)
+        self.relations = {int(new_ids[id]): relations for id, relations in self.relations.items()}
+        return new_ids
+
+    # Returns new (starts, counts, pool) with the given ranges of a pool packed back to back
+    def _gather(self, pool, starts, counts):
+        new_starts = np.cumsum(counts, dtype=np.int64) - counts
+        return new_starts, counts, pool.data[ranges(starts, counts)]
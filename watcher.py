@@ -0,0 +1,126 @@
+import json
+import os
+import time
+
+# File in the data directory the scan index is kept in
+SCAN_INDEX_FILE = "scan_index.json"
+SCAN_INDEX_VERSION = 1
+# Default seconds between scans of the watched directory
+WATCH_INTERVAL = 5
+# Default seconds a file has to go unmodified before it is catalogued, so files still being written are left for a later scan
+WATCH_DEBOUNCE = 2
+# Default number of files catalogued per batch, the database is saved once per batch
+WATCH_BATCH_SIZE = 64
+
+# Yields (path, signature) of the files in a directory in name order, the signature is (size, mtime in ns, inode)
+# Files are listed with os.scandir, so nothing but the directory entries and their stat results are read
+# Paths ending in one of the skipped extensions and skipped paths (files or directories) are left out,
+# files removed while listing are passed over
+def scan_files(root, skip_extensions=(), skip_paths=(), recursive=False):
+    directories = [root]
+    while directories:
+        try:
+            with os.scandir(directories.pop()) as iterator:
+                entries = sorted(iterator, key=lambda entry: entry.name)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.path in skip_paths:
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                    continue
+                if not entry.is_file() or entry.name.lower().endswith(skip_extensions):
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            yield entry.path, (stat.st_size, stat.st_mtime_ns, entry.inode())
+        if recursive:
+            # Popped last first, so subdirectories are listed in name order
+            directories.extend(reversed(subdirectories))
+
+# Signatures of the files catalogued from a watched directory, kept in a JSON file between runs
+# A file whose size, mtime or inode differ from its signature is catalogued again
+class ScanIndex:
+    def __init__(self, path=None, files=None):
+        self.path = path
+        self.files = files or {} # Signature by file path
+
+    # Loads the index, a missing or unreadable file gives an empty index
+    def from_file(path):
+        try:
+            with open(path, 'r') as file:
+                data = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return ScanIndex(path)
+        if data.get('version') != SCAN_INDEX_VERSION:
+            return ScanIndex(path)
+        return ScanIndex(path, {path: tuple(signature) for path, signature in data['files'].items()})
+
+    def is_current(self, path, signature):
+        return self.files.get(path) == signature
+
+    def update(self, path, signature):
+        self.files[path] = signature
+
+    # Drops the files which no longer exist
+    def prune(self, paths):
+        self.files = {path: signature for path, signature in self.files.items() if path in paths}
+
+    # Writes the index next to its path first, so an interrupted save keeps the previous index
+    def save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as file:
+            json.dump({'version': SCAN_INDEX_VERSION, 'files': self.files}, file)
+        os.replace(temp_path, self.path)
+
+# Watches a directory and feeds the files which are new or changed since they were last catalogued to a callback in batches
+# Each scan lists the directory once and compares it against the scan index, only changed files are returned
+class Watcher:
+    def __init__(self, root, index, debounce=WATCH_DEBOUNCE, batch_size=WATCH_BATCH_SIZE, skip_extensions=(), skip_paths=(), recursive=False):
+        self.root = root
+        self.index = index
+        self.debounce = debounce
+        self.batch_size = max(1, batch_size)
+        self.skip_extensions = tuple(skip_extensions)
+        self.skip_paths = set(skip_paths)
+        self.recursive = recursive
+
+    # Returns (path, signature) of the changed files which have settled, at most batch_size, and whether more are ready
+    # Files modified within the debounce time are left for a later scan
+    def scan(self, now=None):
+        now = time.time() if now is None else now
+        settled_before = (now - self.debounce) * 1e9
+        seen = set()
+        ready = []
+        more = False
+        for path, signature in scan_files(self.root, self.skip_extensions, self.skip_paths, self.recursive):
+            seen.add(path)
+            if self.index.is_current(path, signature) or signature[1] > settled_before:
+                continue
+            if len(ready) < self.batch_size:
+                ready.append((path, signature))
+            else:
+                more = True
+        self.index.prune(seen)
+        return ready, more
+
+    # Scans the directory every interval seconds and passes the paths of each batch of changed files to process_batch
+    # The scan index is saved after each batch, files changed while their batch was catalogued are catalogued again
+    # With once, returns when no more files are ready instead of waiting for new files
+    def run(self, process_batch, interval=WATCH_INTERVAL, once=False):
+        while True:
+            ready, more = self.scan()
+            if ready:
+                process_batch([path for path, _ in ready])
+                for path, signature in ready:
+                    self.index.update(path, signature)
+                self.index.save()
+            if more:
+                continue
+            if once:
+                return
+            time.sleep(interval)